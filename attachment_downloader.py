@@ -0,0 +1,70 @@
+import asyncio
+import hashlib
+import os
+import aiohttp
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp')
+DOCUMENT_EXTENSIONS = ('.txt', '.pdf', '.doc', '.docx')
+
+
+class AttachmentRejected(Exception):
+    """附件超過大小上限或類型不支援"""
+
+
+class AttachmentDownloader:
+    """
+    串流下載 Discord 附件：
+    - 下載前先依副檔名與宣告大小拒絕不支援或過大的檔案
+    - 邊下載邊寫入暫存檔並計算 SHA-256（寫入在執行緒中進行，不阻塞事件迴圈），實際大小超過上限時立即中止
+    - 完成後才改名為正式檔名，不會留下一半的檔案
+    """
+
+    def __init__(self, max_bytes=25 * 1024 * 1024, allowed_extensions=IMAGE_EXTENSIONS + DOCUMENT_EXTENSIONS,
+                 chunk_size=64 * 1024, timeout=120):
+        self.max_bytes = max_bytes
+        self.allowed_extensions = allowed_extensions
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self._session = None
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self._session
+
+    def check(self, filename, size=None):
+        """下載前的檢查，不通過時拋出 AttachmentRejected"""
+        ext = os.path.splitext(filename)[1].lower()
+        if ext not in self.allowed_extensions:
+            raise AttachmentRejected(f"不支援的檔案類型 {ext or '(無副檔名)'}")
+        if size is not None and size > self.max_bytes:
+            raise AttachmentRejected(f"檔案過大（{size / 1e6:.1f} MB，上限 {self.max_bytes / 1e6:.0f} MB）")
+
+    async def download(self, attachment, file_path):
+        """下載附件到 file_path，回傳內容的 SHA-256"""
+        self.check(attachment.filename, attachment.size)
+        digest = hashlib.sha256()
+        received = 0
+        part_path = file_path + ".part"
+        try:
+            async with self._get_session().get(attachment.url) as response:
+                response.raise_for_status()
+                if response.content_length is not None and response.content_length > self.max_bytes:
+                    raise AttachmentRejected(f"檔案過大（上限 {self.max_bytes / 1e6:.0f} MB）")
+                with open(part_path, "wb") as f:
+                    async for block in response.content.iter_chunked(self.chunk_size):
+                        received += len(block)
+                        if received > self.max_bytes:
+                            raise AttachmentRejected(f"檔案過大（上限 {self.max_bytes / 1e6:.0f} MB）")
+                        digest.update(block)
+                        await asyncio.to_thread(f.write, block)
+            os.replace(part_path, file_path)
+        except BaseException:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            raise
+        return digest.hexdigest()
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
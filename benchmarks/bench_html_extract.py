@@ -0,0 +1,135 @@
+"""
+比較網頁正文擷取的吞吐量：原本的 BeautifulSoup(html.parser) + 兩次 regex 與 html_extract.extract_text
+
+語料為 --corpus 目錄中儲存的 *.html 網頁：
+- 以 --save URL [URL ...] 下載網頁存入語料目錄（之後可離線重複量測）
+- 目錄中沒有網頁時，產生 --synthetic 個模擬新聞/部落格版面的網頁
+用法：python benchmarks/bench_html_extract.py [--corpus benchmarks/html_corpus] [--save URL ...] [--rounds 3]
+"""
+import argparse
+import hashlib
+import os
+import platform
+import random
+import re
+import sys
+import time
+
+from bs4 import BeautifulSoup
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import html_extract  # noqa: E402
+
+DEFAULT_CORPUS = os.path.join(ROOT, "benchmarks", "html_corpus")
+MAX_CHARS = 20000
+
+
+def legacy_extract(html, max_chars=MAX_CHARS):
+    """原本 fetch_url_content 的做法：以 html.parser 解析整頁、對全文做兩次 regex 清理後才截斷"""
+    soup = BeautifulSoup(html, 'html.parser')
+    for tag in soup(['script', 'style', 'meta', 'link', 'header', 'footer', 'nav']):
+        tag.decompose()
+    text = soup.get_text(separator="\n").strip()
+    text = re.sub(r'\n+', '\n', text)
+    text = re.sub(r'\s+', ' ', text)
+    return text[:max_chars]
+
+
+def soup_extract(html, max_chars=MAX_CHARS):
+    """html_extract 在沒有 lxml 時的 BeautifulSoup 路徑"""
+    return html_extract._extract_soup(html, max_chars)
+
+
+def save_pages(urls, corpus):
+    import http_pool
+    os.makedirs(corpus, exist_ok=True)
+    for url in urls:
+        try:
+            res = http_pool.get(url, timeout=15)
+            res.raise_for_status()
+        except Exception as e:
+            print(f"[ERROR] 無法下載 {url}: {e}")
+            continue
+        name = hashlib.sha1(url.encode("utf-8")).hexdigest()[:12] + ".html"
+        with open(os.path.join(corpus, name), "wb") as f:
+            f.write(res.content)
+        print(f"[DEBUG] 已儲存 {url} -> {name} ({len(res.content)} bytes)")
+
+
+def synthetic_page(rng, paragraphs):
+    """模擬常見版面：大量導覽列、內嵌 script/style、側欄，正文在 <article> 中"""
+    words = ["效能", "模型", "資料", "伺服器", "查詢", "快取", "network", "latency", "throughput", "Discord",
+             "embedding", "token", "文件", "搜尋", "結果"]
+
+    def sentence():
+        return " ".join(rng.choice(words) for _ in range(rng.randint(8, 30))) + "。"
+
+    nav = "".join(f'<li><a href="/c/{i}">分類 {i}</a></li>' for i in range(200))
+    script = "<script>" + "var x=%d;" * 2000 % tuple(range(2000)) + "</script>"
+    style = "<style>" + ".c%d{margin:0}" * 1000 % tuple(range(1000)) + "</style>"
+    body = "".join(f"<h2>{sentence()}</h2>" if i % 10 == 0 else f"<p>{' '.join(sentence() for _ in range(5))}</p>"
+                   for i in range(paragraphs))
+    aside = "".join(f'<div class="ad"><a href="/ad/{i}">{sentence()}</a></div>' for i in range(100))
+    return (f"<!DOCTYPE html><html><head><meta charset='utf-8'><title>{sentence()}</title>{style}{script}</head>"
+            f"<body><header><nav><ul>{nav}</ul></nav></header><main><article>{body}</article></main>"
+            f"<aside>{aside}</aside>{script}<footer>{sentence()}</footer></body></html>")
+
+
+def load_corpus(corpus, synthetic):
+    pages = []
+    if os.path.isdir(corpus):
+        for name in sorted(os.listdir(corpus)):
+            if name.endswith((".html", ".htm")):
+                with open(os.path.join(corpus, name), "rb") as f:
+                    raw = f.read()
+                pages.append((name, raw.decode(html_extract.sniff_encoding(raw), errors="replace")))
+    if not pages:
+        rng = random.Random(0)
+        pages = [(f"synthetic-{i}", synthetic_page(rng, rng.choice((20, 200, 2000)))) for i in range(synthetic)]
+    return pages
+
+
+def run(label, extract, pages, rounds):
+    total_bytes = sum(len(html.encode("utf-8")) for _, html in pages)
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        chars = sum(len(extract(html, MAX_CHARS)) for _, html in pages)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print(f"{label:<26} {best * 1000:8.1f} ms | {len(pages) / best:7.1f} pages/s | "
+          f"{total_bytes / best / 1024 / 1024:6.1f} MB/s | {chars} chars")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", default=DEFAULT_CORPUS)
+    parser.add_argument("--save", nargs="+", metavar="URL")
+    parser.add_argument("--synthetic", type=int, default=12)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.save:
+        save_pages(args.save, args.corpus)
+    pages = load_corpus(args.corpus, args.synthetic)
+    size = sum(len(html) for _, html in pages)
+    synthetic = pages[0][0].startswith("synthetic-")
+    # 結果附上環境與語料，數字才能重現比較
+    import bs4
+    lxml_version = ".".join(map(str, html_extract.etree.LXML_VERSION)) if html_extract.lxml is not None else "未安裝"
+    print(f"Python {platform.python_version()} ({platform.machine()}, {os.cpu_count()} CPU) | "
+          f"beautifulsoup4 {bs4.__version__} | lxml {lxml_version}")
+    print(f"語料：{'合成網頁（random seed 0）' if synthetic else args.corpus}，{len(pages)} 個網頁，"
+          f"共 {size / 1024 / 1024:.1f} MB 字元，最多擷取 {MAX_CHARS} 字元，每組取 {args.rounds} 次中最快的一次")
+
+    run("legacy html.parser+regex", legacy_extract, pages, args.rounds)
+    run("extract_text (soup)", soup_extract, pages, args.rounds)
+    if html_extract.lxml is not None:
+        run("extract_text (lxml)", html_extract.extract_text, pages, args.rounds)
+    else:
+        print("未安裝 lxml，略過 lxml 路徑")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+比較共用連線池（http_pool）與每次新建連線（requests.get）的延遲
+
+在本機啟動一個 HTTP/1.1 stub server；每條新連線先等待 --handshake-ms 毫秒，模擬 TCP/TLS 建立連線的成本
+用法：python benchmarks/bench_http_pool.py [--requests 200] [--handshake-ms 20] [--concurrency 8]
+"""
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import http_pool  # noqa: E402
+
+BODY = b'{"response": "ok", "done": true}\n' * 32
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # 支援 keep-alive
+    handshake_delay = 0.02
+    connections = 0
+
+    def setup(self):
+        super().setup()
+        # 每條新連線只付一次建立成本
+        StubHandler.connections += 1
+        time.sleep(self.handshake_delay)
+
+    def _reply(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(BODY)))
+        self.end_headers()
+        self.wfile.write(BODY)
+
+    do_GET = _reply
+    do_POST = _reply
+
+    def log_message(self, *args):
+        pass
+
+
+def run(label, fetch, url, count, concurrency):
+    StubHandler.connections = 0
+    latencies = []
+
+    def one(_):
+        start = time.perf_counter()
+        fetch(url).content
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, range(count)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    print(f"{label:<22} total {elapsed * 1000:8.1f} ms | mean {statistics.mean(latencies) * 1000:6.2f} ms | "
+          f"p50 {latencies[len(latencies) // 2] * 1000:6.2f} ms | p95 {latencies[int(len(latencies) * 0.95)] * 1000:6.2f} ms | "
+          f"connections {StubHandler.connections}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--handshake-ms", type=float, default=20)
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+
+    StubHandler.handshake_delay = args.handshake_ms / 1000
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/api/generate"
+    print(f"stub server {url}，{args.requests} 個請求，建立連線成本 {args.handshake_ms} ms")
+
+    for concurrency in (1, args.concurrency):
+        print(f"-- 同時 {concurrency} 個請求")
+        run("unpooled requests.get", lambda u: requests.get(u, timeout=10), url, args.requests, concurrency)
+        session = http_pool.make_session(pool_maxsize=concurrency)
+        run("pooled http_pool", lambda u: session.get(u, timeout=10), url, args.requests, concurrency)
+        session.close()
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
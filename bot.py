@@ -1,7 +1,8 @@
 import json
 import discord
 from discord.ext import commands
-import requests
+import asyncio
+import http_pool
 
 # 載入配置文件
 with open("config.json", "r") as config_file:
@@ -110,11 +111,13 @@ async def chat(ctx, *, user_input: str):
         # 增加繁體中文的上下文指引
         full_prompt = f"如我用繁體中文問問題，也請你用繁體中文回答以下問題 ，並避免使用任何特殊字符：{user_input}"
 
-        # 向 Ollama API 發送請求
-        response = requests.post(
+        # 向 Ollama API 發送請求（共用連線池，在執行緒中執行避免阻塞 event loop）
+        response = await asyncio.to_thread(
+            http_pool.post,
             OLLAMA_API_URL,
             json={"model": current_model, "prompt": full_prompt},
-            headers={"Content-Type": "application/json"}
+            headers={"Content-Type": "application/json"},
+            timeout=(5, 600)
         )
 
         if response.status_code == 200:
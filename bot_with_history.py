@@ -1,8 +1,6 @@
 import json
 import discord
 from discord.ext import commands
-import requests
-from langchain.memory import ConversationBufferMemory
 import time
 import asyncio
 import os
@@ -14,9 +12,28 @@ import glob
 import ollama
 # 導入 PDF 轉換函數
 from ollama_tool import *
-import pymupdf4llm
-import pymupdf.pro
-pymupdf.pro.unlock()
+import ollama_tool
+from channel_session import SessionRegistry
+from conversation_store import ConversationStore
+import token_counter
+from token_counter import count_tokens
+from context_budget import plan_context, choose_num_ctx
+from summarizer import RollingSummarizer
+from scheduler import RequestScheduler, QueueFullError
+from discord_streamer import DiscordStreamRenderer
+from document_ingest import DocumentIngestor, IngestTimeoutError
+from attachment_downloader import AttachmentDownloader, AttachmentRejected
+from conversion_cache import ConversionCache
+from document_index import DocumentIndex
+from memory_index import MemoryIndex
+from image_cache import ImageCache
+from image_selector import ImageSelector, image_captions
+from janitor import Janitor
+from file_manifest import ManifestRegistry
+from tool_runner import ToolRunner
+from tool_cache import ToolResultCache
+from prefetcher import SearchPrefetcher
+from page_summarizer import PageSummarizer, chat_model_context
 
 # 模型對應的最大 token 限制
 MODEL_MAX_TOKENS = {
@@ -44,17 +61,26 @@ tools = [
     generate_function_description(fetch_url_content),
     generate_function_description(do_math),
 ]
-# 儲存當前選擇的模型
+# 工具調用：同一回合的多個調用同時執行，每個工具有各自的同時執行上限與逾時
+tool_runner = ToolRunner(
+    {
+        "get_local_time": get_local_time,
+        "google_search": google_search,
+        "fetch_url_content": fetch_url_content,
+        "do_math": do_math,
+        "get_current_weather": get_current_weather,
+    },
+    limits={"google_search": 2, "fetch_url_content": 4},
+    # fetch_url_content 會以 LLM 分段摘要網頁，需要比一般網路工具長的時間上限
+    timeouts={"fetch_url_content": 180},
+    # 搜尋、網頁與天氣結果依 TTL 快取（記憶體 LRU + SQLite），所有頻道共用
+    cache=ToolResultCache(disk_path="tool_cache.sqlite3"))
+# 預設模型（各頻道的模型存放在自己的 session 中）
 current_model = "mistral-small3.1"  # 預設模型
 client = ollama.Client(host="http://localhost:11434")
+# 非同步 client，串流與工具循環都走這條路徑，避免阻塞 event loop
+async_client = ollama.AsyncClient(host="http://localhost:11434")
 
-# 初始化記憶功能（臨時使用，每次對話前都會重新加載頻道特定的記憶）
-memory = ConversationBufferMemory(
-    memory_key="history",
-    return_messages=False,
-    max_len=128000)  # 默認為 phi4 的最大 token 限制
-# 紀錄下載的檔案內容
-file_contents = []
 # 載入配置文件
 with open("config.json", "r") as config_file:
     config = json.load(config_file)
@@ -67,213 +93,167 @@ OLLAMA_API_URL = "http://localhost:11434/api/generate"
 # 指定上線訊息的頻道 ID
 STATUS_CHANNEL_ID = 1073495605286027267  # 替換為你的頻道 ID
 ALLOWED_CHANNEL_IDS = config["ALLOWED_CHANNEL_IDS"]
+# token 計數：可在 config.json 指定本機已下載的 tokenizer（HuggingFace 名稱或路徑）
+token_counter.configure(config.get("TOKENIZER"))
+# 每次請求為模型回答預留的 token 數（num_ctx = prompt + 預留量，向上取到 2 的次方）
+ANSWER_RESERVE_TOKENS = config.get("ANSWER_RESERVE_TOKENS", 2048)
+
+# 所有頻道的對話、文件、圖片與計數器都存放在同一個 SQLite 資料庫
+store = ConversationStore(config.get("DATABASE_PATH", "bot_data.sqlite3"))
+# 每個頻道一個 session（記憶、模型、token 上限），首次使用時從資料庫載入
+sessions = SessionRegistry(store, current_model, MODEL_MAX_TOKENS)
+
+# 生成請求排程：全域同時生成上限與每個頻道的排隊上限
+scheduler = RequestScheduler(
+    max_concurrent=config.get("MAX_CONCURRENT_GENERATIONS", 2),
+    max_queue_per_channel=config.get("MAX_QUEUE_PER_CHANNEL", 5))
+
+# 背景滾動摘要：頻道閒置後把較舊的對話折疊進摘要，不佔用使用者請求的時間
+summarizer = RollingSummarizer(
+    async_client,
+    scheduler,
+    keep_recent_turns=config.get("SUMMARY_KEEP_RECENT_TURNS", 8),
+    idle_delay=config.get("SUMMARY_IDLE_SECONDS", 30),
+    summary_model=config.get("SUMMARY_MODEL"),
+    model_max_tokens=MODEL_MAX_TOKENS)
+
+# 網頁摘要（fetch_url_content）：長網頁分段同時摘要，應指定較小的模型（未指定時使用預設模型）
+# 所有網頁摘要共用 PAGE_SUMMARY_MAX_CONCURRENT 個生成名額
+if not config.get("PAGE_SUMMARY_MODEL"):
+    print("[WARNING] 未設定 PAGE_SUMMARY_MODEL，網頁摘要將使用對話模型（沿用對話的 num_ctx），速度較慢")
+ollama_tool.page_summarizer = PageSummarizer(
+    client,
+    model=config.get("PAGE_SUMMARY_MODEL"),
+    chunk_tokens=config.get("PAGE_SUMMARY_CHUNK_TOKENS", 3000),
+    max_workers=config.get("PAGE_SUMMARY_WORKERS", 4),
+    max_concurrent=config.get("PAGE_SUMMARY_MAX_CONCURRENT", 2))
+# 搜尋結果預取：google_search 回傳後在背景下載前幾個結果（0 表示關閉），每個回答回合有下載預算
+if config.get("PREFETCH_SEARCH_RESULTS", 0) > 0:
+    ollama_tool.prefetcher = SearchPrefetcher(
+        ollama_tool.load_page_text,
+        top_n=config["PREFETCH_SEARCH_RESULTS"],
+        turn_budget_bytes=config.get("PREFETCH_TURN_MB", 6) * 1024 * 1024)
+
+# 附件串流下載：大小上限與允許的類型在下載前與下載中檢查
+downloader = AttachmentDownloader(max_bytes=config.get("MAX_ATTACHMENT_MB", 25) * 1024 * 1024)
+
+# 上傳文件在常駐的 process pool 中轉換，不阻塞 event loop；相同內容的檔案共用轉換快取
+conversion_cache = ConversionCache(
+    config.get("CONVERSION_CACHE_DIR", "conversion_cache"),
+    max_bytes=config.get("CONVERSION_CACHE_MAX_MB", 1024) * 1024 * 1024)
+ingestor = DocumentIngestor(
+    max_workers=config.get("INGEST_WORKERS"),
+    timeout=config.get("INGEST_TIMEOUT_SECONDS", 300),
+    pages_per_batch=config.get("INGEST_PAGES_PER_BATCH", 20),
+    cache=conversion_cache)
+
+# 上傳文件的檢索設定：文件總長度超過 RETRIEVAL_INLINE_TOKENS 時，只放入與問題最相關的段落
+EMBED_MODEL = config.get("EMBED_MODEL", "nomic-embed-text")
+RETRIEVAL_TOP_K = config.get("RETRIEVAL_TOP_K", 6)
+RETRIEVAL_CHUNK_TOKENS = config.get("RETRIEVAL_CHUNK_TOKENS", 400)
+RETRIEVAL_INLINE_TOKENS = config.get("RETRIEVAL_INLINE_TOKENS", 2000)
+# 長期記憶：prompt 只放最近 MEMORY_RECENT_TURNS 則訊息，加上語意上最相關的 MEMORY_TOP_K 筆過往問答
+MEMORY_RECENT_TURNS = config.get("MEMORY_RECENT_TURNS", 8)
+MEMORY_TOP_K = config.get("MEMORY_TOP_K", 4)
+# 圖片依模型輸入解析度縮小並快取編碼結果，之後的回合直接重用
+image_cache = ImageCache(
+    config.get("IMAGE_CACHE_DIR", "image_cache"),
+    max_memory_bytes=config.get("IMAGE_CACHE_MEMORY_MB", 64) * 1024 * 1024,
+    max_disk_bytes=config.get("IMAGE_CACHE_MAX_MB", 512) * 1024 * 1024)
+# 每回合只附加相關的圖片，避免視覺模型處理所有歷史圖片
+image_selector = ImageSelector(async_client, EMBED_MODEL, min_score=config.get("IMAGE_MIN_SCORE", 0.35))
+# 每個頻道目錄的檔案索引，檔案存入或刪除時更新，不必重複掃描目錄
+manifests = ManifestRegistry()
+# 背景清理：過期或超量的圖片、已使用完的上傳文件，不在請求路徑上處理
+janitor = Janitor(
+    store,
+    manifests,
+    interval=config.get("JANITOR_INTERVAL_SECONDS", 300),
+    max_images=config.get("MAX_CHANNEL_IMAGES", 10),
+    max_idle_turns=config.get("MAX_IMAGE_IDLE_TURNS", 10),
+    pdf_image_ttl=config.get("PDF_IMAGE_TTL_SECONDS", 3600),
+    max_channel_bytes=config.get("MAX_CHANNEL_MB", 500) * 1024 * 1024)
+# 背景任務的參考，避免尚未完成就被回收
+background_tasks = set()
 
 # 初始化 Bot
 intents = discord.Intents.default()
 intents.messages = True  # 啟用訊息事件
 intents.message_content = True  # 啟用訊息內容訪問
-bot = commands.Bot(command_prefix="++", intents=intents)
 
 
-
-def is_in_allowed_channel(ctx):
-    return ctx.channel.id in ALLOWED_CHANNEL_IDS
+class HistoryBot(commands.Bot):
+    async def close(self):
+        # 需要 event loop 才能關閉的資源在這裡關閉（bot.run 結束後 loop 已關閉）
+        await downloader.close()
+        await super().close()
 
 
-def update_memory_limit():
-    """根據當前模型更新記憶最大 token 限制（只更新記憶大小，不影響內容）"""
-    global memory
-    max_tokens = MODEL_MAX_TOKENS.get(current_model, 8192)  # 默認為 8192
-    # 只更新 token 限制，不會清除任何記憶內容
-    memory = ConversationBufferMemory(
-        memory_key="history",
-        return_messages=False,
-        max_len=max_tokens)
-    print(f"[DEBUG] 記憶最大 token 限制更新為: {max_tokens}")
+bot = HistoryBot(command_prefix="++", intents=intents)
 
 
-def save_history_to_file(channel_id):
-    """將記憶歷史保存到頻道特定的 JSON 文件中"""
-    if not channel_id:
-        print("[WARNING] 未提供頻道 ID，無法保存記憶")
-        return
-        
-    context = memory.load_memory_variables({})
-    # 確保頻道目錄存在
-    os.makedirs(str(channel_id), exist_ok=True)
-    history_file_path = os.path.join(str(channel_id), "history.json")
-    with open(history_file_path, "w", encoding="utf-8") as history_file:
-        json.dump(context, history_file, ensure_ascii=False, indent=4)
-    print(f"[DEBUG] 頻道 {channel_id} 的記憶已保存到 {history_file_path}")
-
-
-def load_history_from_file(channel_id):
-    """從頻道特定的 JSON 文件中載入記憶歷史"""
-    global memory
-    
-    # 重置記憶（確保不會混合不同頻道的記憶）
-    memory = ConversationBufferMemory(max_token_limit=MODEL_MAX_TOKENS.get(current_model, 8192))
-    
-    if not channel_id:
-        print("[WARNING] 未提供頻道 ID，無法載入記憶")
-        return False
-        
-    # 載入指定頻道的歷史記憶
-    history_file_path = os.path.join(str(channel_id), "history.json")
-    if os.path.exists(history_file_path):
-        try:
-            with open(history_file_path, "r", encoding="utf-8") as history_file:
-                context = json.load(history_file)
-                if "history" in context:
-                    # 將歷史加載到記憶中
-                    memory.save_context({"input": ""}, {"output": context["history"]})
-                    print(f"[DEBUG] 已載入頻道 {channel_id} 的記憶歷史")
-                    return True
-        except Exception as e:
-            print(f"[ERROR] 載入頻道 {channel_id} 的記憶歷史時出錯: {e}")
-    else:
-        print(f"[DEBUG] 頻道 {channel_id} 沒有歷史記憶文件，使用空記憶")
-    
-    return False
-
 
-def trim_memory_with_ollama(channel_id):
-    """使用 Ollama 模型裁剪記憶歷史"""
-    if not channel_id:
-        print("[WARNING] 未提供頻道 ID，無法裁剪記憶")
-        return
-        
-    context = memory.load_memory_variables({})
-    history = context.get("history", "")
-    estimated_tokens = len(history.split())  # 簡單估算token數
-    
-    # 如果token數小於最大限制的50%，不需裁減
-    if estimated_tokens < MODEL_MAX_TOKENS[current_model] * 0.5:
-        print(f"[DEBUG] 當前token數（約{estimated_tokens}）不需裁減")
-        return
-
-    # 發送請求到 Ollama 模型
-    trim_prompt = """請分析以下對話歷史，並進行重要內容提取：
-    1. 保留關鍵的上下文信息
-    2. 保持對話的連貫性
-    3. 優先保留最近的對話
-    4. 刪除重複或不重要的內容
-    
-    對話歷史：
-    {history}
-    
-    請提供精簡後的重要對話：""".format(history=history)
-
-    response = requests.post(
-        OLLAMA_API_URL,
-        json={"model": current_model, "prompt": trim_prompt},
-        headers={"Content-Type": "application/json"}
-    )
-
-    if response.status_code == 200:
-        try:
-            result = response.json()
-            trimmed_history = result.get("response", "")
-            print("[DEBUG] 裁剪後的記憶歷史：", trimmed_history)
-            print(f"[DEBUG] 裁剪前token數：{estimated_tokens}，裁剪後token數：{len(trimmed_history.split())}")
-
-            # 更新記憶
-            memory.save_context({"input": ""}, {"output": trimmed_history})
-            save_history_to_file(channel_id)  # 保存裁剪後的記憶
-        except json.JSONDecodeError as e:
-            print("[ERROR] 無法解析裁剪回應：", e)
-    else:
-        print("[ERROR] Ollama API 返回錯誤：", response.status_code, response.text)
+def is_in_allowed_channel(ctx):
+    return ctx.channel.id in ALLOWED_CHANNEL_IDS
 
 
-def process_user_input(user_input, channel_id):
+async def process_user_input(user_input, channel_id):
     """處理用戶輸入，使用 Ollama API 並儲存記憶"""
     try:
-        # 先加載頻道特定的記憶
-        load_history_from_file(channel_id)
-        
-        # 檢查並可能裁減記憶
-        context = memory.load_memory_variables({})
-        current_tokens = len(context.get("history", "").split())  # 簡單估算token數
-        
-        # 如果超過最大限制的80%，觸發裁減
-        if current_tokens > MODEL_MAX_TOKENS[current_model] * 0.8:
-            print(f"[DEBUG] 當前token數（約{current_tokens}）超過限制的80%，觸發裁減")
-            trim_memory_with_ollama(channel_id)
-            # 重新載入裁減後的上下文
-            context = memory.load_memory_variables({})
-
-        prompt_with_memory = context.get("history", "") + f"\nUser: {user_input}\nBot:"
-
-        print("[DEBUG] Prompt sent to Ollama API:", prompt_with_memory)
+        # 取得頻道特定的 session（記憶已常駐記憶體，不需每次從磁碟重新載入）
+        session = sessions.get(channel_id)
+        # 舊對話由背景任務摘要，這裡只讀取最新摘要與最近的回合
         start_time = time.time()
-        full_prompt = f"如我用繁體中文問問題，也請你用繁體中文回答，並不使用任何特殊字符和表情：{prompt_with_memory}"
-        prompt_with_memory = full_prompt
-        prompt_with_memory = handle_promt_history(context)
-        prompt_with_memory.append({"role": "user", "content": user_input})
+        memories, recent_turns = await recall_memories(session, user_input)
+        plan = handle_promt_history(session, user_input, memories=memories, recent_turns=recent_turns)
+        print("[DEBUG] Prompt sent to Ollama API:", plan.messages)
         
-        response = client.chat(
-            model=current_model,
-            messages=prompt_with_memory,
-            stream=False  # 啟用串流模式
+        response = await async_client.chat(
+            model=session.model,
+            messages=plan.messages,
+            options=plan.options,
+            stream=False
         )
         # 計算處理時間
         elapsed_time = time.time() - start_time
         
-        # ollama.Client().chat() 返回的是 ChatResponse 對象
+        # ollama.AsyncClient().chat() 返回的是 ChatResponse 對象
         # 從回應中獲取內容
         if response and 'message' in response and 'content' in response['message']:
             bot_response = response['message']['content']
             # 更新記憶
-            memory.save_context({"input": user_input}, {"output": bot_response})
+            session.add_exchange(user_input, bot_response)
+            remember_exchange(session)  # 背景更新語意記憶索引
+            summarizer.schedule(session)  # 閒置時在背景折疊舊對話
             print("[DEBUG] Response processed:", bot_response)
-            save_history_to_file(channel_id)  # 保存記憶歷史
             return bot_response.strip(), elapsed_time
         else:
             raise Exception("模型未返回有效內容，請稍後再試。")
     except Exception as e:
         raise Exception(f"處理請求時發生錯誤：{e}")
 
-def handle_file_upload(filepath):
-    """處理文件上傳，並返回文件內容"""
+async def handle_file_upload(filepath, channel_id, on_progress=None, sha256=None):
+    """處理文件上傳，文件轉換在 process pool 中執行；on_progress(已完成頁數, 總頁數)，sha256 為下載時計算的雜湊"""
     try:
         ext = os.path.splitext(filepath)[1].lower()
-        # 使用絕對路徑來獲取頻道 ID 和文件目錄
+        # 使用絕對路徑來獲取文件目錄
         abs_filepath = os.path.abspath(filepath)
         channel_dir = os.path.dirname(abs_filepath) # 獲取頻道目錄的絕對路徑
-        channel_id = os.path.basename(channel_dir) # 假設頻道目錄名稱就是頻道 ID
+        session = sessions.get(channel_id)
+        manifest = manifests.get(channel_id)
+        manifest.add(filepath, sha256=sha256)
         
         print(f"[DEBUG] 處理文件 (絕對路徑): {abs_filepath}")
         print(f"[DEBUG] 文件類型: {ext}")
         print(f"[DEBUG] 頻道目錄 (絕對路徑): {channel_dir}")
         print(f"[DEBUG] 頻道 ID: {channel_id}")
         
-        # 讀取或初始化頻道的文件內容 (使用絕對路徑)
-        file_contents_path = os.path.join(channel_dir, 'file_contents.json')
-        
-        try:
-            if os.path.exists(file_contents_path):
-                print(f"[DEBUG] 發現現有的 file_contents.json")
-                with open(file_contents_path, 'r', encoding='utf-8') as f:
-                    channel_file_contents = json.load(f)
-            else:
-                print(f"[DEBUG] 未找到 file_contents.json，將創建新的")
-                channel_file_contents = []
-        except Exception as e:
-            print(f"[ERROR] 讀取文件內容列表時出錯: {e}")
-            channel_file_contents = []
-        
         # 處理圖片檔案
         if ext in ('.png', '.jpg', '.jpeg', '.gif', '.bmp'):
             try:
-                # 重置閒置計數
-                idle_count_path = os.path.join(channel_dir, 'idle_count.json')
-                try:
-                    with open(idle_count_path, 'w', encoding='utf-8') as f:
-                        json.dump({'idle_count': 0}, f, ensure_ascii=False, indent=4)
-                    print(f"[DEBUG] 已重置閒置計數")
-                except Exception as e:
-                    print(f"[ERROR] 重置閒置計數時出錯: {e}")
+                # 登記圖片（閒置與數量限制由背景清理處理）
+                store.add_image(channel_id, filepath.replace('\\', '/'), "upload")
+                print(f"[DEBUG] 已登記圖片")
                 return True
             except Exception as e:
                 print(f"[ERROR] 圖片處理錯誤: {e}")
@@ -281,96 +261,41 @@ def handle_file_upload(filepath):
         
         # 處理文字檔案
         else:
-            file_content = read_file_content(abs_filepath) # 使用絕對路徑
+            file_content, image_paths = await ingestor.convert(abs_filepath, on_progress, sha256) # 使用絕對路徑
             print(f"[DEBUG] 讀取到的文件內容: {file_content[:200]}...")  # 只打印前200個字符
             
             if file_content != "[Unsupported file type]":
-                # 添加新的文件內容
-                # 使用絕對路徑記錄檔案名稱
-                new_content = f"檔案名稱: {abs_filepath}\n檔案內容: {file_content}"
-                channel_file_contents.append(new_content)
-                
-                # 保存更新後的文件內容列表
+                # 添加新的文件內容（使用絕對路徑記錄檔案名稱）
                 try:
-                    with open(file_contents_path, 'w', encoding='utf-8') as f:
-                        json.dump(channel_file_contents, f, ensure_ascii=False, indent=4)
-                    print(f"[DEBUG] 成功寫入 file_contents.json")
+                    session.add_document(abs_filepath, file_content)
+                    # 先建立索引，提問時只需要 embed 問題
+                    try:
+                        await document_index_for(session).add(abs_filepath, file_content)
+                    except Exception as e:
+                        print(f"[WARNING] 建立文件索引失敗，提問時再重試: {e}")
+                    # 登記 PDF 中擷取出的圖片，並以圖片周圍的文字作為說明供相關性比對
+                    captions = image_captions(file_content, image_paths)
+                    document_name = os.path.basename(abs_filepath)
+                    for image_path in image_paths:
+                        caption = f"{document_name} {captions.get(image_path, '')}".strip()
+                        store.add_image(channel_id, image_path, "pdf", caption=caption)
+                        if os.path.exists(image_path):
+                            manifest.add(image_path)
+                    print(f"[DEBUG] 成功寫入文件內容，擷取圖片 {len(image_paths)} 張")
                 except Exception as e:
-                    print(f"[ERROR] 寫入 file_contents.json 時出錯: {e}")
+                    print(f"[ERROR] 寫入文件內容時出錯: {e}")
                     return False
                 return True
             else:
                 print(f"[WARNING] 不支援的檔案類型: {filepath}")
                 return False
                 
+    except IngestTimeoutError:
+        raise
     except Exception as e:
         print(f"[ERROR] 檔案處理錯誤: {e}")
         return False
 
-def image_idle_check(channel_id):
-    """檢查並管理圖片快取
-    - 每次被提及時增加閒置計數
-    - 當圖片超過最大數量或閒置次數過多時清理
-    - 清理時優先清理最舊的圖片
-    """
-    # 設定最大圖片數量和最大閒置次數
-    MAX_IMAGES = 10
-    MAX_IDLE_COUNT = 10
-    
-    try:
-        # 讀取或初始化閒置計數
-        idle_count_path = os.path.join(str(channel_id), 'idle_count.json')
-        if os.path.exists(idle_count_path):
-            with open(idle_count_path, 'r', encoding='utf-8') as f:
-                idle_count = json.load(f).get('idle_count', 0)
-        else:
-            idle_count = 0
-        
-        # 增加閒置計數
-        idle_count += 1
-        
-        # 獲取所有圖片檔案
-        image_dir = str(channel_id)
-        image_files = []
-        for ext in ['.png', '.jpg', '.jpeg', '.gif', '.bmp']:
-            image_files.extend(glob.glob(os.path.join(image_dir, f"*{ext}")))
-            image_files.extend(glob.glob(os.path.join(image_dir, f"*{ext.upper()}")))
-        
-        # 根據修改時間排序圖片（最舊的在前）
-        image_files.sort(key=lambda x: os.path.getmtime(x))
-        
-        # 檢查閒置次數
-        if idle_count > MAX_IDLE_COUNT and image_files:
-            # 移除最舊的圖片
-            try:
-                os.remove(image_files[0])
-                print(f"[DEBUG] 太久沒用，已移除最舊的圖片: {image_files[0]}")
-                image_files.pop(0)  # 從列表中移除
-            except Exception as e:
-                print(f"[ERROR] 刪除閒置圖片時出錯: {e}")
-        
-        # 檢查圖片數量是否超過限制
-        while len(image_files) > MAX_IMAGES:
-            try:
-                os.remove(image_files[0])
-                print(f"[DEBUG] 圖片數量超過限制，已移除最舊的圖片: {image_files[0]}")
-                image_files.pop(0)
-            except Exception as e:
-                print(f"[ERROR] 刪除超量圖片時出錯: {e}")
-                break
-        
-        # 保存更新後的閒置計數
-        with open(idle_count_path, 'w', encoding='utf-8') as f:
-            json.dump({'idle_count': idle_count}, f, ensure_ascii=False, indent=4)
-            
-    except Exception as e:
-        print(f"[ERROR] 圖片快取管理錯誤: {e}")
-        # 發生錯誤時重置閒置計數
-        if os.path.exists(idle_count_path):
-            with open(idle_count_path, 'w', encoding='utf-8') as f:
-                json.dump({'idle_count': 0}, f, ensure_ascii=False, indent=4)
-
-
 # def image_to_base64(image_path):
 #     """將圖片轉換為 base64 編碼"""
 #     try:
@@ -394,87 +319,13 @@ def image_idle_check(channel_id):
 #     except Exception as e:
 #         print(f"[ERROR] 圖片轉換錯誤 {image_path}: {e}")
 #         return None
-def read_pdf_content(filepath):
-    # 讓 to_markdown() 回傳每一頁的結構化資料，並提取圖片
-    channel_dir = os.path.dirname(filepath) # 獲取頻道目錄的絕對路徑
-    channel_id = os.path.basename(channel_dir) # 假設頻道目錄名稱就是頻道 ID
-        
-    chunks = pymupdf4llm.to_markdown(
-        doc=filepath,
-        write_images=True,
-        image_format='jpg',
-        image_path=channel_id+"/pdf_images",  # 使用相對路徑，會自動在頻道目錄下建立
-        page_chunks=True
-    )
-
-    # 取得所有頁面中圖片的檔案名稱
-    pdf_text=''
-    image_filenames = []
-    for page in chunks:
-        pdf_text += f'page {page["metadata"]["page"]}:\n'
-        pdf_text += f'{page["text"]}'
-    # 利用正則表達式抓取所有符合 Markdown 圖片語法的部分
-    image_filenames = re.findall(r'!\[\]\((images/[^)]+\.jpg)\)', pdf_text)
-
-    return pdf_text, image_filenames
-
-def read_file_content(filepath):
-    """讀取文件內容"""
-    ext = os.path.splitext(filepath)[1].lower()
-    
-    try:
-        if ext == '.txt':
-            with open(filepath, 'r', encoding='utf-8') as f:
-                content = f.read()
-                return content if content.strip() else "[Empty file]"
-       
-        elif ext == '.pdf'or ext == '.doc' or ext == '.docx':
-            # 確保 PDF 文件路徑是絕對路徑
-            pdf_filepath = os.path.abspath(filepath)
-            
-            # PDF to markdown基礎轉換
-            # md_text = pymupdf4llm.to_markdown(pdf_filepath)
-            md_text, image_filenames = read_pdf_content(pdf_filepath)
-            return md_text if md_text.strip() else "[Empty file]"
-
-            # # 獲取 PDF 文件所在的頻道目錄
-            # channel_dir = os.path.dirname(pdf_filepath)
-            
-            # # 設定輸出的 HTML 文件的絕對路徑
-            # html_filename = os.path.splitext(os.path.basename(pdf_filepath))[0] + '.html'
-            # html_filepath = os.path.abspath(os.path.join(channel_dir, html_filename))
-            
-            # print("debug, pdf_filepath:", pdf_filepath)
-            # print("debug, html_filepath:", html_filepath)
-            
-            # # 轉換 PDF 到 HTML
-            # if convert_pdf_to_html(pdf_filepath, html_filepath):
-            #     # 如果轉換成功,讀取 HTML 內容
-            #     try:
-            #         with open(html_filepath, 'r', encoding='utf-8') as f:
-            #             content = f.read()
-            #         # 刪除生成的 HTML 文件
-            #         # try:
-            #         #     os.remove(html_filepath)
-            #         # except:
-            #         #     pass
-            #         return content
-            #     except Exception as e:
-            #         return f"[Error reading converted HTML file: {str(e)}]"
-            # else:
-            #     return "[PDF conversion failed]"
-        else:
-            return "[Unsupported file type]"
-    except UnicodeDecodeError:
-        return "[File encoding error]"
-    except Exception as e:
-        print(f"[ERROR] 檔案讀取錯誤 {filepath}: {e}")
-        return f"[Error reading file: {str(e)}]"
 
 @bot.event
 async def on_ready():
     """當 Bot 上線時觸發"""
     print("Bot 已成功啟動！")
+    ingestor.warm_up()
+    janitor.start()
     print(f"已登入 Discord 帳戶：{bot.user}")
 
     # 發送上線通知到所有允許的頻道
@@ -529,8 +380,12 @@ async def chat(ctx, *, user_input: str):
         print(f"收到指令：{user_input}")
         thinking_message = await ctx.send(f"已收到：{user_input}，正在思考...")
 
-        # 生成 Ollama 回應，傳入頻道 ID
-        response, _ = process_user_input(user_input, ctx.channel.id)
+        async def show_queue_position(position):
+            await thinking_message.edit(content=f"已收到：{user_input}，排隊中，目前順位：第 {position} 位...")
+
+        # 生成 Ollama 回應，傳入頻道 ID（經過排程器取得生成名額）
+        async with scheduler.slot(ctx.channel.id, show_queue_position):
+            response, _ = await process_user_input(user_input, ctx.channel.id)
         response = response.strip()
         await thinking_message.delete()
 
@@ -538,6 +393,8 @@ async def chat(ctx, *, user_input: str):
             await ctx.send(response)
         else:
             await ctx.send("模型未返回內容或發生錯誤，請稍後再試。")
+    except QueueFullError:
+        await thinking_message.edit(content="❗️ 此頻道排隊中的請求過多，請稍後再試。")
     except Exception as e:
         print("[ERROR] Exception in chat command:", e)
         await ctx.send(f"出現錯誤：{e}")
@@ -546,13 +403,12 @@ async def chat(ctx, *, user_input: str):
 @bot.command()
 @commands.check(is_in_allowed_channel)
 async def setmodel(ctx, model_name: str):
-    """設定使用的模型"""
-    global current_model
+    """設定當前頻道使用的模型"""
     available_models = ["gemma3:nsfw2", "gemma3:27b","gemma3:12b","deepseek-r1:32b"]
     if model_name in available_models:
-        current_model = model_name
-        update_memory_limit()  # 更新記憶限制
-        print("[DEBUG] Model switched to:", model_name)
+        # 只切換這個頻道的模型與記憶限制，不影響其他頻道
+        sessions.get(ctx.channel.id).set_model(model_name, MODEL_MAX_TOKENS.get(model_name, 8192))
+        print(f"[DEBUG] 頻道 {ctx.channel.id} Model switched to:", model_name)
         await ctx.send(f"已將模型切換為 `{model_name}`，記憶最大限制更新為 {MODEL_MAX_TOKENS[model_name]} tokens。")
     else:
         print("[ERROR] Invalid model name:", model_name)
@@ -563,136 +419,147 @@ async def setmodel(ctx, model_name: str):
 @commands.check(is_in_allowed_channel)
 async def clean_history(ctx):
     """清除頻道的記憶歷史和下載的檔案"""
-    global memory
-    
-    # 清除記憶歷史
-    memory = ConversationBufferMemory(
-        max_token_limit=MODEL_MAX_TOKENS.get(current_model, 8192))
+    # 清除記憶歷史（資料庫中的對話、文件、圖片紀錄與計數器）
+    sessions.get(ctx.channel.id).reset()
     print(f"[DEBUG] 頻道 {ctx.channel.id} 的記憶歷史已清除")
     
-    # 清除歷史記憶文件
-    history_file_path = os.path.join(str(ctx.channel.id), "history.json")
-    if os.path.exists(history_file_path):
-        try:
-            os.unlink(history_file_path)
-            print(f"[DEBUG] 已刪除記憶歷史文件: {history_file_path}")
-        except Exception as e:
-            print(f"[ERROR] 刪除記憶歷史文件時出錯 {history_file_path}: {e}")
-    
-    # 清除 userFile 目錄中的所有檔案
+    # 清除 userFile 目錄中的所有檔案（依 manifest 刪除，不需重新掃描目錄）
     try:
-        userfile_dir = str(ctx.channel.id)
-        if os.path.exists(userfile_dir):
-            for filename in os.listdir(userfile_dir):
-                file_path = os.path.join(userfile_dir, filename)
-                try:
-                    if os.path.isfile(file_path):
-                        os.unlink(file_path)
-                        print(f"[DEBUG] 已刪除檔案: {file_path}")
-                except Exception as e:
-                    print(f"[ERROR] 刪除檔案時出錯 {file_path}: {e}")
-            print(f"[DEBUG] 頻道 {ctx.channel.id} 的檔案目錄已清空")
+        freed = manifests.get(ctx.channel.id).clear()
+        print(f"[DEBUG] 頻道 {ctx.channel.id} 的檔案目錄已清空（釋放 {freed / 1e6:.1f} MB）")
     except Exception as e:
         print(f"[ERROR] 清理頻道 {ctx.channel.id} 的檔案目錄時出錯: {e}")
     
     await ctx.send(f"頻道 {ctx.channel.name} 的記憶歷史和下載的檔案已成功清除！")
 
 
-def handle_promt_history(context):
-    """處理歷史對話，轉換為 messages 格式"""
-    # 初始化消息歷史
-    messages = [
-        {"role": "system", "content": """如果使用者用繁體中文問你，也請你用繁體中文回答。
+SYSTEM_PROMPT = """如果使用者用繁體中文問你，也請你用繁體中文回答。
         遇到數學問題時，請先嘗試用tool進行計算。
         另外，遇到不會的問題時請使用tool進行google搜尋並fetch_url進行閱讀，最終回答時須附上參考網站的href。
-        請不要使用任何特殊字符和表情。"""},
-    ]
-    
-    # 解析並添加歷史記憶到消息中
-    history_content = context.get("history", "")
-    if history_content:
-        # 分割歷史內容為獨立的對話回合
-        # 使用 "Human:" 作為分隔點來分割對話
-        conversations = history_content.split("Human: ")
-        
-        # 跳過第一個空元素（如果存在）
-        conversations = [conv for conv in conversations if conv.strip()]
-        
-        for conv in conversations:
-            # 分割用戶輸入和 AI 回應
-            parts = conv.split("AI: ", 1)
-            if len(parts) == 2:
-                user_input, ai_response = parts
-                
-                # 清理並添加用戶訊息
-                user_input = user_input.strip()
-                if user_input:
-                    messages.append({
-                        "role": "user",
-                        "content": user_input
-                    })
-                
-                # 清理並添加 AI 回應
-                ai_response = ai_response.strip()
-                if ai_response:
-                    messages.append({
-                        "role": "assistant",
-                        "content": ai_response
-                    })
-    
-    
-    return messages
+        請不要使用任何特殊字符和表情。"""
+
+
+def document_index_for(session):
+    """取得頻道的文件索引（不存在時建立）"""
+    if session.document_index is None:
+        session.document_index = DocumentIndex(
+            async_client, EMBED_MODEL, chunk_tokens=RETRIEVAL_CHUNK_TOKENS, top_k=RETRIEVAL_TOP_K)
+    return session.document_index
 
-async def stream_response(user_input, channel_id,thinking_messages):
+async def retrieve_documents(session, question):
     """
-    使用流式請求從 Ollama API 取得部分回應，並每兩秒 yield 當前累積內容
+    回傳要放進 prompt 的檔案內容：
+    文件不長時直接使用全文，否則只取與問題最相關的 top-k 段落
     """
-    # 加載頻道特定的記憶
-    load_history_from_file(channel_id)
-    
-    # 整合上下文記憶
-    context = memory.load_memory_variables({})
-    current_tokens = len(context.get("history", "").split())  # 簡單估算token數
-    
-    # 如果超過最大限制的80%，觸發裁減
-    if current_tokens > MODEL_MAX_TOKENS[current_model] * 0.8:
-        print(f"[DEBUG] 當前token數（約{current_tokens}）超過限制的80%，觸發裁減")
-        trim_memory_with_ollama(channel_id)
-        # 重新載入裁減後的上下文
-        context = memory.load_memory_variables({})
-
-    # 添加歷史記憶到消息中
-    messages = handle_promt_history(context)
-
-    # 直接從 userFile 目錄讀取所有 .jpg 檔案
-    image_dir = str(channel_id)
-    image_set = set()
-    for ext in ['.png', '.jpg', '.jpeg', '.gif', '.bmp']:
-        image_files = glob.glob(os.path.join(image_dir, f"*{ext}"))
-        image_files.extend(glob.glob(os.path.join(image_dir, f"*{ext.upper()}")))
-        # 將反斜線轉換為正斜線
-        image_files = [path.replace('\\', '/') for path in image_files]
-        image_set.update(image_files)
-    image_list = sorted(image_set)
-    
-    # pdf img
-    pdf_image_dir = os.path.join(str(channel_id), "pdf_images")
-    if os.path.exists(pdf_image_dir):  # 確認 pdf_images 目錄存在
-        pdf_image_set = set()
-        for ext in ['.png', '.jpg', '.jpeg', '.gif', '.bmp']:
-            pdf_files = glob.glob(os.path.join(pdf_image_dir, f"*{ext}"))
-            pdf_files.extend(glob.glob(os.path.join(pdf_image_dir, f"*{ext.upper()}")))
-            # 將反斜線轉換為正斜線
-            pdf_files = [path.replace('\\', '/') for path in pdf_files]
-            pdf_image_set.update(pdf_files)
-        image_list.extend(sorted(pdf_image_set))  # 將 PDF 圖片加入主列表
+    documents = session.documents()
+    if not documents or not question:
+        return documents
+    # 長文件的 token 計算可能花上數百毫秒，放到執行緒中以免阻塞事件迴圈
+    total_tokens = await asyncio.to_thread(lambda: sum(count_tokens(d) for d in documents))
+    if total_tokens <= RETRIEVAL_INLINE_TOKENS:
+        return documents
+
+    index = document_index_for(session)
+    try:
+        # 重新啟動後索引是空的，從資料庫中的文件補建
+        for i, (path, content) in enumerate(store.list_documents(session.channel_id)):
+            await index.add(path or f"檔案 {i + 1}", content)
+        hits = await index.search(question)
+    except Exception as e:
+        print(f"[ERROR] 文件檢索失敗，改用截斷的全文: {e}")
+        return documents
+
+    grouped = {}
+    for source, chunk in hits:
+        grouped.setdefault(source, []).append(chunk)
+    print(f"[DEBUG] 文件檢索：{len(index)} 個段落中選出 {len(hits)} 個")
+    return [f"檔案名稱: {source}\n相關段落:\n" + "\n...\n".join(chunks) for source, chunks in grouped.items()]
+
+def memory_index_for(session):
+    """取得頻道的語意記憶索引（不存在時從資料庫載入）"""
+    if session.memory_index is None:
+        session.memory_index = MemoryIndex(async_client, EMBED_MODEL, store, session.channel_id, top_k=MEMORY_TOP_K)
+    return session.memory_index
+
+def remember_exchange(session):
+    """在背景把最新的問答加入語意記憶索引，不延遲回覆"""
+    # 在排程當下取得索引與回合：若之後頻道被清除，舊索引已被捨棄，不會寫回清除前的問答
+    index = memory_index_for(session)
+    turns = session.history.turns[-2:]
+
+    async def run():
+        try:
+            await index.add_turns(turns)
+        except Exception as e:
+            print(f"[WARNING] 更新語意記憶索引失敗，下次提問時再補: {e}")
+    task = asyncio.create_task(run())
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+async def recall_memories(session, question):
+    """
+    回傳 (相關的過往問答, 最近視窗的訊息數)
+    檢索失敗時回傳 ((), None)，prompt 改為依預算放入完整歷史
+    """
+    turns = session.history.turns
+    try:
+        index = memory_index_for(session)
+        # 補上尚未索引的回合（例如更新前的歷史或先前 embed 失敗的問答）
+        await index.add_turns(turns)
+        recent = turns[-MEMORY_RECENT_TURNS:]
+        memories = await index.search(question, before=recent[0].id if recent else None)
+    except Exception as e:
+        print(f"[ERROR] 語意記憶檢索失敗，改用完整歷史: {e}")
+        return (), None
+    if memories:
+        print(f"[DEBUG] 語意記憶：{len(index)} 筆中選出 {len(memories)} 筆")
+    return memories, MEMORY_RECENT_TURNS
+
+def handle_promt_history(session, user_input, documents=(), images=(), memories=(), recent_turns=None):
+    """依 context 預算組合系統提示、對話歷史、相關過往問答、上傳檔案與圖片，回傳 ContextPlan（含 messages 與 num_ctx）"""
+    plan = plan_context(
+        SYSTEM_PROMPT,
+        session.history,
+        user_input,
+        session.model,
+        session.max_tokens,
+        documents=documents,
+        images=images,
+        answer_reserve=ANSWER_RESERVE_TOKENS,
+        memories=memories,
+        recent_turns=recent_turns)
+    print(f"[DEBUG] prompt 約 {plan.prompt_tokens} tokens，num_ctx={plan.num_ctx}，"
+          f"捨棄歷史 {plan.dropped_turns} 則、圖片 {plan.dropped_images} 張、截斷文件 {plan.truncated_documents} 份")
+    return plan
+
+async def select_channel_images(session, question):
+    """挑選這一回合要附加的圖片：指定的、上一回合後新上傳的、以及與問題相關的（不超過模型的圖片預算）"""
+    records = store.list_image_records(session.channel_id)
+    since = session.history.turns[-1].timestamp if session.history.turns else 0
+    image_list = await image_selector.select(question, records, since, session.model)
     
-    print(f"[DEBUG] 使用 {len(image_list)} 張圖片，包含一般圖片和 PDF 圖片")
+    print(f"[DEBUG] 從 {len(records)} 張圖片中選出 {len(image_list)} 張")
     if image_list:
         print(f"[DEBUG] 圖片列表: {image_list}")
     
-    # 添加用戶輸入
-    messages.append({"role": "user", "content": user_input,"images": image_list})
+    return image_list
+
+async def stream_response(user_input, channel_id, thinking_messages, image_list, documents=()):
+    """
+    使用流式請求從 Ollama API 取得部分回應，每收到新片段就 yield 當前累積內容
+    """
+    # 取得頻道特定的 session
+    session = sessions.get(channel_id)
+    
+    # 舊對話由背景任務摘要，這裡只讀取最新摘要與最近的回合，不在請求路徑上等待摘要
+    # 依 context 預算組合歷史記憶、用戶輸入、檔案內容與圖片
+    memories, recent_turns = await recall_memories(session, user_input)
+    plan = handle_promt_history(session, user_input, documents, image_list, memories, recent_turns)
+    messages = plan.messages
+    prompt_tokens = plan.prompt_tokens
+    # 只編碼實際放進 prompt 的圖片（已縮小並快取的結果）
+    if messages[-1].get("images"):
+        messages[-1]["images"] = await image_cache.encode_many(messages[-1]["images"], session.model)
     """備份，不要刪
     # 建立 ollama client 並使用 stream 模式呼叫 chat API
     
@@ -719,31 +586,35 @@ async def stream_response(user_input, channel_id,thinking_messages):
     #     yield buffer
     # 內部循環處理工具調用
     """
+    # 本回合的搜尋結果預取，回答結束時取消尚未完成的部分
+    prefetch_turn = ollama_tool.prefetcher.begin_turn() if ollama_tool.prefetcher is not None else None
     try:
         while True:
             # 調用LLM
-            print("[DEBUG] input messages:", json.dumps(messages, ensure_ascii=False, indent=2))
-            stream = client.chat(
-                model=current_model,
+            print("[DEBUG] input messages:", json.dumps(
+                [{k: v for k, v in m.items() if k != "images"} for m in messages], ensure_ascii=False, indent=2))
+            # 依目前 prompt 大小（含工具結果）選擇最小的 num_ctx
+            num_ctx = choose_num_ctx(prompt_tokens, ANSWER_RESERVE_TOKENS, session.max_tokens)
+            stream = await async_client.chat(
+                model=session.model,
                 messages=messages,
                 tools=tools,
+                options={"num_ctx": num_ctx},
                 stream=True  # 啟用串流模式
             )
             
             # 依據 stream 回傳的資料塊持續 yield 累積內容
             buffer = ""
-            last_update_time = time.time()
             tool_calls = []          # 儲存工具調用
             
-            for chunk in stream:
+            async for chunk in stream:
                 if 'message' in chunk:
                     if 'content' in chunk['message']:
                         new_text = chunk['message']['content']
                         if new_text:  # 確保新文本不為空
                             buffer += new_text
-                            if time.time() - last_update_time >= 0.5 and buffer:  # 每0.5秒更新一次
-                                yield buffer
-                                last_update_time = time.time()
+                            # 每個片段都 yield，Discord 端的刷新節奏由 DiscordStreamRenderer 控制
+                            yield buffer
                     # 處理工具調用
                     if 'tool_calls' in chunk['message']:
                         for tool_call in chunk['message']['tool_calls']:
@@ -758,45 +629,39 @@ async def stream_response(user_input, channel_id,thinking_messages):
             if tool_calls:
                 print(f"[DEBUG] 發現工具調用: {len(tool_calls)} 個")
                 
-                # 處理工具調用
-                for tool_call in tool_calls:
-                    try:
-                        tool_name = tool_call['function']['name']
-                        arguments_str = tool_call['function']['arguments']
-                        
-                        # 解析參數 (確保是字典格式)
-                        try:
-                            arguments = json.loads(arguments_str) if isinstance(arguments_str, str) else arguments_str
-                        except json.JSONDecodeError:
-                            print(f"[ERROR] 無法解析工具參數: {arguments_str}")
-                            arguments = {}
-                            
-                        # 更新狀態訊息
-                        tool_status = f"🔧 正在使用工具：{tool_name}\n"
-                        tool_status += f"參數：{json.dumps(arguments, ensure_ascii=False)}"
-                        # 使用 asyncio.create_task 避免阻塞
-                        # 我們不等待它完成，因為它可能會失敗，但不應該阻止流程
-                        yield f"{buffer}\n\n{tool_status}"
-                        
-                        # 動態執行工具函數
-                        print(f"[DEBUG] 調用工具: {tool_name} 參數: {arguments}")
-                        result = globals()[tool_name](**arguments)
-                        print(f"[DEBUG] 工具結果: {result[:200]}...") if isinstance(result, str) and len(result) > 200 else print(f"[DEBUG] 工具結果: {result}")
-                        
+                # 所有工具調用同時執行（工具內部是同步網路請求，在執行緒池中執行），結果依調用順序加入
+                names = ", ".join(call['function']['name'] for call in tool_calls)
+                yield f"{buffer}\n\n🔧 正在使用工具：{names}"
+                print(f"[DEBUG] 調用工具: {[(c['function']['name'], c['function']['arguments']) for c in tool_calls]}")
+                tool_start = time.monotonic()
+                # 未指定 PAGE_SUMMARY_MODEL 時，網頁摘要沿用這次對話的模型與 num_ctx，避免 Ollama 重新載入模型
+                context_token = chat_model_context.set((session.model, num_ctx))
+                try:
+                    outcomes = await tool_runner.run_all(tool_calls)
+                finally:
+                    chat_model_context.reset(context_token)
+                print(f"[DEBUG] {len(outcomes)} 個工具共耗時 {time.monotonic() - tool_start:.2f} 秒")
+
+                tool_results = []
+                for tool_name, arguments, result, error in outcomes:
+                    if error is None and tool_name == "google_search" and prefetch_turn is not None:
+                        # 模型通常接著讀取前幾個結果，先在背景下載
+                        prefetch_turn.start(result)
+                    if error is None:
+                        print(f"[DEBUG] 工具結果: {result[:200]}...") if len(result) > 200 else print(f"[DEBUG] 工具結果: {result}")
                         # 將工具結果添加到消息歷史
                         messages.append({"role": "tool", "content": result})
-                        
-                        # 顯示工具執行結果
-                        tool_result = f"{buffer}\n\n🔧 工具 {tool_name} 執行結果：\n{result[:500]}..."
-                        if len(result) <= 500:
-                            tool_result = f"{buffer}\n\n🔧 工具 {tool_name} 執行結果：\n{result}"
-                        yield tool_result
-                    except Exception as e:
-                        error_msg = f"工具 {tool_name} 執行錯誤: {str(e)}"
+                        prompt_tokens += count_tokens(result)
+                        shown = result if len(result) <= 500 else f"{result[:500]}..."
+                        tool_results.append(f"🔧 工具 {tool_name} 執行結果：\n{shown}")
+                    else:
+                        error_msg = f"工具 {tool_name} 執行錯誤: {str(error)}"
                         print(f"[ERROR] {error_msg}")
-                        yield f"{buffer}\n\n❌ {error_msg}"
-                        # 工具失敗時仍然添加空結果到歷史，以便模型知道工具被調用但失敗了
-                        messages.append({"role": "tool", "content": f"Error: {str(e)}"})
+                        tool_results.append(f"❌ {error_msg}")
+                        # 工具失敗時仍然添加結果到歷史，以便模型知道工具被調用但失敗了
+                        messages.append({"role": "tool", "content": f"Error: {str(error)}"})
+                # 顯示工具執行結果
+                yield f"{buffer}\n\n" + "\n\n".join(tool_results)
             else:
                 # 沒有工具調用，結束循環
                 break
@@ -805,55 +670,15 @@ async def stream_response(user_input, channel_id,thinking_messages):
         error_message = f"[ERROR] stream_response 發生錯誤: {str(e)}"
         print(error_message)
         yield f"❌ {error_message}"
+    finally:
+        if prefetch_turn is not None:
+            prefetch_turn.cancel()
         
-    # 回答完後的清理工作
+    # 回答完後清除已使用的文件內容；檔案本身由背景清理刪除
     try:
-        # 1. 清理文字檔案內容的 JSON
-        file_contents_path = os.path.join(str(channel_id), 'file_contents.json')
-        if os.path.exists(file_contents_path):
-            try:
-                os.remove(file_contents_path)
-                print(f"[DEBUG] 已刪除處理完的文字檔案內容: {file_contents_path}")
-            except Exception as e:
-                print(f"[ERROR] 刪除文字檔案內容時出錯: {e}")
-        
-        # 2. 清理原始的文字檔案（保留圖片檔案）
-        channel_dir = str(channel_id)
-        if os.path.exists(channel_dir):
-            for filename in os.listdir(channel_dir):
-                file_path = os.path.join(channel_dir, filename)
-                # 只刪除文字檔案，保留圖片和 JSON 配置檔案
-                if os.path.isfile(file_path) and filename.lower().endswith(('.txt', '.pdf')):
-                    try:
-                        os.remove(file_path)
-                        print(f"[DEBUG] 已刪除處理完的原始文字檔案: {file_path}")
-                    except Exception as e:
-                        print(f"[ERROR] 刪除原始文字檔案時出錯 {file_path}: {e}")
-                        
-        # 3. 清理 PDF 圖片（如果存在且超過 30 分鐘）
-        pdf_image_dir = os.path.join(str(channel_id), "pdf_images")
-        if os.path.exists(pdf_image_dir):
-            current_time = time.time()
-            for filename in os.listdir(pdf_image_dir):
-                file_path = os.path.join(pdf_image_dir, filename)
-                # 檢查檔案是否超過 30 分鐘
-                if os.path.isfile(file_path) and (current_time - os.path.getmtime(file_path)) > 3600:
-                    try:
-                        os.remove(file_path)
-                        print(f"[DEBUG] 已刪除超過 60 分鐘的 PDF 圖片: {file_path}")
-                    except Exception as e:
-                        print(f"[ERROR] 刪除 PDF 圖片時出錯 {file_path}: {e}")
-            
-            # 如果 pdf_images 目錄為空，則刪除該目錄
-            if not os.listdir(pdf_image_dir):
-                try:
-                    os.rmdir(pdf_image_dir)
-                    print(f"[DEBUG] 已刪除空的 PDF 圖片目錄: {pdf_image_dir}")
-                except Exception as e:
-                    print(f"[ERROR] 刪除 PDF 圖片目錄時出錯: {e}")
-                    
+        session.clear_documents()
     except Exception as e:
-        print(f"[ERROR] 執行清理工作時出錯: {e}")
+        print(f"[ERROR] 清除已使用的文件內容時出錯: {e}")
 
 @bot.event
 async def on_message(message):
@@ -869,30 +694,66 @@ async def on_message(message):
         # 發送初始處理訊息
         processing_msg = await message.channel.send("📂 正在處理上傳的檔案...")
         
-        # 用於記錄處理結果的列表
-        processing_results = []
-        
-        for attachment in message.attachments:
+        # 同一則訊息中有同名附件時，檔名加上附件 ID，避免互相覆蓋
+        filenames = [attachment.filename for attachment in message.attachments]
+
+        def stored_name(attachment):
+            if filenames.count(attachment.filename) > 1:
+                stem, ext = os.path.splitext(attachment.filename)
+                return f"{stem}_{attachment.id}{ext}"
+            return attachment.filename
+
+        # 每個附件的處理進度（檔名 -> 狀態文字），定期更新到處理訊息上
+        progress = {stored_name(attachment): "等待中" for attachment in message.attachments}
+        last_edit = 0.0
+
+        async def report_progress():
+            nonlocal last_edit
+            now = time.monotonic()
+            if now - last_edit < 1.5:
+                return
+            last_edit = now
+            lines = [f"`{name}`: {state}" for name, state in progress.items()]
+            try:
+                await processing_msg.edit(content="📂 正在處理上傳的檔案...\n" + "\n".join(lines))
+            except discord.HTTPException as e:
+                print(f"[WARNING] 更新處理進度失敗: {e}")
+
+        async def process_attachment(attachment):
             # 設定儲存路徑
-            file_path = os.path.join(str(message.channel.id), attachment.filename)
-            # 下載檔案
-            await attachment.save(file_path)
-            print(f"[DEBUG] 已下載檔案: {file_path}")
-            
-            # 讀取檔案內容
+            name = stored_name(attachment)
+            file_path = os.path.join(str(message.channel.id), name)
+
+            async def on_progress(done, total):
+                progress[name] = f"轉換中 {done}/{total} 頁"
+                await report_progress()
+
             try:
-                result = handle_file_upload(file_path)
+                # 串流下載檔案（同時計算雜湊），下載完成就開始處理，不等待其他附件
+                progress[name] = "下載中"
+                sha256 = await downloader.download(attachment, file_path)
+                print(f"[DEBUG] 已下載檔案: {file_path}")
+                progress[name] = "轉換中"
+                # 讀取檔案內容
+                result = await handle_file_upload(file_path, message.channel.id, on_progress, sha256)
+                progress[name] = "完成" if result else "失敗"
                 if result:
                     ext = os.path.splitext(file_path)[1].lower()
                     if ext in ('.png', '.jpg', '.jpeg', '.gif', '.bmp'):
-                        processing_results.append(f"✅ 圖片 `{attachment.filename}` 處理成功")
-                    else:
-                        processing_results.append(f"✅ 文件 `{attachment.filename}` 處理成功")
-                else:
-                    processing_results.append(f"❌ 檔案 `{attachment.filename}` 處理失敗")
+                        return f"✅ 圖片 `{name}` 處理成功"
+                    return f"✅ 文件 `{name}` 處理成功"
+                return f"❌ 檔案 `{name}` 處理失敗"
+            except AttachmentRejected as e:
+                progress[name] = "已拒絕"
+                return f"⛔ 檔案 `{name}` 未處理：{e}"
             except Exception as e:
                 print(f"[ERROR] 讀取檔案錯誤: {e}")
-                processing_results.append(f"❌ 檔案 `{attachment.filename}` 處理出錯: {str(e)}")
+                progress[name] = "失敗"
+                return f"❌ 檔案 `{name}` 處理出錯: {str(e)}"
+
+        # 同一則訊息的多個附件同時下載與轉換，結果依附件順序顯示
+        processing_results = await asyncio.gather(
+            *(process_attachment(attachment) for attachment in message.attachments))
 
         # 更新處理訊息，顯示所有檔案的處理結果
         result_message = "📋 檔案處理結果：\n" + "\n".join(processing_results)
@@ -900,20 +761,15 @@ async def on_message(message):
 
     # 當訊息提及 Bot 時
     if bot.user.mentioned_in(message):
-        image_idle_check(message.channel.id)
         user_input = message.content.replace(bot.user.mention, "").strip()
         
         # 讀取頻道的文件內容
-        file_contents_path = os.path.join(str(message.channel.id), 'file_contents.json')
-        channel_file_contents = []
-        if os.path.exists(file_contents_path):
-            try:
-                with open(file_contents_path, 'r', encoding='utf-8') as f:
-                    channel_file_contents = json.load(f)
-            except Exception as e:
-                print(f"[ERROR] 讀取文件內容列表時出錯: {e}")
+        session = sessions.get(message.channel.id)
+        # 文件較長時只取與問題相關的段落
+        channel_file_contents = await retrieve_documents(session, user_input)
         
-        # 如果有檔案，將檔案內容加入到用戶輸入中
+        # 問題與檔案內容分開傳入，由 context 預算決定檔案內容放入多少；歷史記錄問題與實際使用的段落
+        question = user_input
         if channel_file_contents:
             file_content_text = "\n\n".join(channel_file_contents)
             user_input = f"{user_input}\n\n用戶上傳的檔案：\n{file_content_text}"
@@ -927,29 +783,38 @@ async def on_message(message):
         first_msg = await message.channel.send("🤖 收到提及，正在思考...")
         thinking_messages.append(first_msg)
         final_response = ""  # 儲存最終完整回應
+        queued = False
+
+        async def show_queue_position(position):
+            nonlocal queued
+            queued = True
+            try:
+                await first_msg.edit(content=f"⏳ 排隊中，目前順位：第 {position} 位，請稍候...")
+            except Exception as e:
+                print(f"[DEBUG] 更新排隊順位失敗: {e}")
+
         try:
-            # 非同步迭代器取得逐步更新的回應
-            async for partial in stream_response(user_input, message.channel.id,thinking_messages):
-                final_response = partial  # 更新最新累積回應
-                # 將累積的回應切割為多個不超過2000字的段落
-                segments = [partial[i:i+2000] for i in range(0, len(partial), 2000)]
-                for idx, seg in enumerate(segments):
-                    if idx < len(thinking_messages):
-                        # 編輯已存在的訊息
-                        try:
-                            await thinking_messages[idx].edit(content=seg)
-                        except Exception as e:
-                            print(f"[DEBUG] 編輯訊息失敗: {e}")
-                    else:
-                        # 發送新訊息
-                        new_msg = await message.channel.send(seg)
-                        thinking_messages.append(new_msg)
-                # 等待0.1秒再處理下一次更新
-                await asyncio.sleep(0.1)
-            # 回應全部取得完畢後，記錄回應歷史
-            memory.save_context({"input": user_input}, {"output": final_response})
-            print("[DEBUG] Full response processed:", final_response)
-            save_history_to_file(message.channel.id)  # 保存頻道特定的記憶歷史
+            # 經過排程器取得生成名額（同一頻道依序處理，不同頻道輪流放行）
+            async with scheduler.slot(message.channel.id, show_queue_position):
+                if queued:
+                    await first_msg.edit(content="🤖 收到提及，正在思考...")
+                image_list = await select_channel_images(session, question)
+                # 非同步迭代器取得逐步更新的回應，交由 renderer 合併並只編輯有變動的段落
+                renderer = DiscordStreamRenderer(message.channel, thinking_messages)
+                try:
+                    async for partial in stream_response(question, message.channel.id, thinking_messages, image_list, channel_file_contents):
+                        final_response = partial  # 更新最新累積回應
+                        renderer.update(partial)
+                    await renderer.finish(final_response)
+                finally:
+                    await renderer.close()
+                # 回應全部取得完畢後，記錄回應歷史
+                session.add_exchange(user_input, final_response, images=image_list)
+                remember_exchange(session)  # 背景更新語意記憶索引
+                summarizer.schedule(session)  # 閒置時在背景折疊舊對話
+                print("[DEBUG] Full response processed:", final_response)
+        except QueueFullError:
+            await first_msg.edit(content="❗️ 此頻道排隊中的請求過多，請稍後再試。")
         except Exception as e:
             # 發生錯誤時更新最後一則訊息
             await thinking_messages[-1].edit(content=f"❗️ 發生錯誤：{e}")
@@ -958,3 +823,10 @@ async def on_message(message):
     await bot.process_commands(message)
 
 bot.run(DISCORD_TOKEN)
+ingestor.close()
+tool_runner.close()
+ollama_tool.page_summarizer.close()
+if ollama_tool.prefetcher is not None:
+    ollama_tool.prefetcher.close()
+tool_runner.cache.close()
+store.close()
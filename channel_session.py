@@ -0,0 +1,160 @@
+import glob
+import json
+import os
+from history_store import ConversationHistory, Turn
+from conversation_store import QUESTION_COUNTER
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp')
+
+
+class ChannelSession:
+    """單一頻道的對話狀態：記憶、模型、token 上限，資料保存在共用的 ConversationStore"""
+
+    def __init__(self, channel_id, model, max_tokens, store):
+        self.channel_id = channel_id
+        self.model = model
+        self.max_tokens = max_tokens
+        self.store = store
+        self.history = ConversationHistory()
+        # 上傳文件的向量索引（DocumentIndex），由 bot 在需要時建立，不保存到資料庫
+        self.document_index = None
+        # 過往問答的語意記憶索引（MemoryIndex），向量保存在資料庫，由 bot 在需要時建立
+        self.memory_index = None
+
+    @property
+    def channel_dir(self):
+        return str(self.channel_id)
+
+    def set_model(self, model, max_tokens):
+        """切換模型，只更新 token 限制，保留現有對話歷史"""
+        self.model = model
+        self.max_tokens = max_tokens
+
+    def load(self):
+        """從資料庫載入對話歷史（只在建立 session 時呼叫一次）"""
+        try:
+            self._migrate_legacy_files()
+            self.history = ConversationHistory(
+                [Turn.from_dict(t) for t in self.store.load_turns(self.channel_id)],
+                summary=self.store.load_summary(self.channel_id))
+            print(f"[DEBUG] 已載入頻道 {self.channel_id} 的記憶歷史（{len(self.history)} 則）")
+        except Exception as e:
+            print(f"[ERROR] 載入頻道 {self.channel_id} 的記憶歷史時出錯: {e}")
+
+    def _migrate_legacy_files(self):
+        """將舊版頻道目錄下的 history / file_contents.json / idle_count.json 與圖片匯入資料庫"""
+        channel_dir = self.channel_dir
+        if not os.path.isdir(channel_dir):
+            return
+
+        legacy_turns = None
+        jsonl_path = os.path.join(channel_dir, "history.jsonl")
+        json_path = os.path.join(channel_dir, "history.json")
+        if os.path.exists(jsonl_path):
+            with open(jsonl_path, "r", encoding="utf-8") as f:
+                records = [json.loads(line) for line in f if line.strip()]
+            # 舊日誌的 token 數是以空白分詞估算，遷移時重新計算
+            legacy_turns = [
+                Turn(r["role"], r.get("content", ""), timestamp=r.get("timestamp"), images=r.get("images"))
+                for r in records
+            ]
+        elif os.path.exists(json_path):
+            # 含舊版 "Human:/AI:" 字串格式
+            with open(json_path, "r", encoding="utf-8") as f:
+                legacy_turns = ConversationHistory.from_dict(json.load(f)).turns
+        if legacy_turns is not None:
+            self.store.replace_turns(self.channel_id, [t.to_dict() for t in legacy_turns])
+            for path in (jsonl_path, json_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            print(f"[DEBUG] 已將頻道 {self.channel_id} 的歷史檔案遷移到資料庫")
+
+        file_contents_path = os.path.join(channel_dir, "file_contents.json")
+        if os.path.exists(file_contents_path):
+            with open(file_contents_path, "r", encoding="utf-8") as f:
+                for content in json.load(f):
+                    self.store.add_document(self.channel_id, "", content)
+            os.remove(file_contents_path)
+
+        # 圖片閒置改由背景清理依提問次數判斷，舊的閒置計數不再使用
+        idle_count_path = os.path.join(channel_dir, "idle_count.json")
+        if os.path.exists(idle_count_path):
+            os.remove(idle_count_path)
+
+        # 已存在於目錄中但尚未登記的圖片
+        known = set(self.store.list_images(self.channel_id))
+        for source, image_dir in (("upload", channel_dir), ("pdf", os.path.join(channel_dir, "pdf_images"))):
+            if not os.path.isdir(image_dir):
+                continue
+            for path in glob.glob(os.path.join(image_dir, "*")):
+                path = path.replace('\\', '/')
+                if path.lower().endswith(IMAGE_EXTENSIONS) and path not in known:
+                    self.store.add_image(self.channel_id, path, source, created_at=os.path.getmtime(path))
+
+    def add_exchange(self, user_input, bot_response, images=None):
+        """記錄一次問答，只新增這次的 turn；同時累計提問次數並記錄這次使用的圖片（供背景清理判斷閒置）"""
+        start = len(self.history.turns)
+        self.history.add_exchange(user_input, bot_response, images=images)
+        new_turns = self.history.turns[start:]
+        for turn, row_id in zip(new_turns, self.store.append_turns(self.channel_id, [t.to_dict() for t in new_turns])):
+            turn.id = row_id
+        seq = self.store.increment_counter(self.channel_id, QUESTION_COUNTER)
+        if images:
+            self.store.mark_images_used(self.channel_id, images, seq)
+
+    def fold_into_summary(self, count, summary):
+        """把最舊的 count 個回合折疊進滾動摘要（單一交易）"""
+        self.history.fold(count, summary)
+        self.store.fold_turns(self.channel_id, count, summary)
+        print(f"[DEBUG] 頻道 {self.channel_id} 已將 {count} 則舊對話折疊進摘要")
+
+    def add_document(self, path, content):
+        """記錄上傳檔案解析後的文字內容"""
+        self.store.add_document(self.channel_id, path, content)
+
+    def documents(self):
+        """回傳尚未使用的上傳檔案內容，格式同舊版 file_contents.json"""
+        return [
+            f"檔案名稱: {path}\n檔案內容: {content}" if path else content
+            for path, content in self.store.list_documents(self.channel_id)
+        ]
+
+    def clear_documents(self):
+        """回答完畢後清除已使用的檔案內容與其索引"""
+        self.store.clear_documents(self.channel_id)
+        self.document_index = None
+
+    def reset(self):
+        """清除記憶、檔案內容、圖片紀錄與計數器"""
+        self.history = ConversationHistory()
+        self.document_index = None
+        if self.memory_index is not None:
+            # 仍在 embed 的背景更新不可把清除前的問答寫回資料庫
+            self.memory_index.discard()
+        self.memory_index = None
+        self.store.clear_channel(self.channel_id)
+
+
+class SessionRegistry:
+    """頻道 ID -> ChannelSession，首次使用時從資料庫載入，之後常駐記憶體"""
+
+    def __init__(self, store, default_model, model_max_tokens):
+        self.store = store
+        self.default_model = default_model
+        self.model_max_tokens = model_max_tokens
+        self._sessions = {}
+
+    def get(self, channel_id):
+        session = self._sessions.get(channel_id)
+        if session is None:
+            max_tokens = self.model_max_tokens.get(self.default_model, 8192)
+            session = ChannelSession(channel_id, self.default_model, max_tokens, self.store)
+            session.load()
+            self._sessions[channel_id] = session
+        return session
+
+    def __contains__(self, channel_id):
+        return channel_id in self._sessions
+
+    def __iter__(self):
+        return iter(list(self._sessions.values()))
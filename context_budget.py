@@ -0,0 +1,174 @@
+from token_counter import count_tokens
+
+# 每張圖片在視覺模型中約佔用的 token 數（依模型名稱前綴比對）
+TOKENS_PER_IMAGE = {
+    "gemma3": 256,
+    "llama3.2-vision": 1601,
+    "mistral-small3.1": 1024,
+}
+DEFAULT_TOKENS_PER_IMAGE = 768
+# 每回合最多附加的圖片數（圖片越多 prompt eval 越久；llama3.2-vision 在 Ollama 只支援單張）
+MAX_IMAGES_PER_TURN = {
+    "gemma3": 3,
+    "llama3.2-vision": 1,
+    "mistral-small3.1": 4,
+}
+DEFAULT_MAX_IMAGES_PER_TURN = 3
+# num_ctx 以 2 的次方分級，避免每個請求的 num_ctx 都不同導致 Ollama 重新載入模型
+MIN_NUM_CTX = 2048
+# 每則訊息的格式開銷（角色標記等）
+MESSAGE_OVERHEAD = 4
+TRUNCATED_MARK = "\n[內容過長，已截斷]"
+
+
+def tokens_per_image(model):
+    for prefix, tokens in TOKENS_PER_IMAGE.items():
+        if model.startswith(prefix):
+            return tokens
+    return DEFAULT_TOKENS_PER_IMAGE
+
+
+def image_budget(model):
+    for prefix, count in MAX_IMAGES_PER_TURN.items():
+        if model.startswith(prefix):
+            return count
+    return DEFAULT_MAX_IMAGES_PER_TURN
+
+
+def choose_num_ctx(prompt_tokens, answer_reserve, max_tokens):
+    """回傳能容納 prompt 與回答保留量的最小分級 num_ctx（不超過模型上限）"""
+    needed = prompt_tokens + answer_reserve
+    num_ctx = MIN_NUM_CTX
+    while num_ctx < needed:
+        num_ctx *= 2
+    return min(num_ctx, max_tokens)
+
+
+def truncate_to_tokens(text, max_tokens):
+    """依比例截斷文字使其約在 max_tokens 以內；預算連截斷標記都放不下時只保留開頭，不加標記"""
+    if max_tokens <= 0:
+        return ""
+    tokens = count_tokens(text)
+    if tokens <= max_tokens:
+        return text
+    mark_tokens = count_tokens(TRUNCATED_MARK)
+    if max_tokens <= mark_tokens:
+        return text[:int(len(text) * max_tokens / tokens)]
+    keep_chars = int(len(text) * (max_tokens - mark_tokens) / tokens)
+    return text[:keep_chars] + TRUNCATED_MARK
+
+
+class ContextPlan:
+    """一次請求的 prompt 配置結果"""
+
+    def __init__(self, messages, prompt_tokens, num_ctx, dropped_turns, dropped_images, truncated_documents):
+        self.messages = messages
+        self.prompt_tokens = prompt_tokens
+        self.num_ctx = num_ctx
+        self.dropped_turns = dropped_turns
+        self.dropped_images = dropped_images
+        self.truncated_documents = truncated_documents
+
+    @property
+    def options(self):
+        return {"num_ctx": self.num_ctx}
+
+
+def format_memories(memories):
+    """相關過往問答對應的 system 訊息"""
+    return {"role": "system", "content": "與目前問題相關的過往對話：\n" + "\n\n".join(memories)}
+
+
+def plan_context(system_prompt, history, user_input, model, max_tokens,
+                 documents=(), images=(), answer_reserve=2048, memories=(), recent_turns=None):
+    """
+    依優先順序把各部分放進模型的 context window：
+    1. 系統提示與使用者問題（必定保留；問題本身超過 context 時截斷到剩餘的預算）
+    2. 回答保留量
+    3. 上傳檔案內容（放不下時截斷）
+    4. 圖片（放不下時捨棄最舊的）
+    5. 滾動摘要
+    6. 對話歷史（從最新往回放，放不下的舊回合捨棄；有 recent_turns 時最多放最近幾回合）
+    7. 語意檢索出的過往問答 memories（[(內容, token 數), ...]）
+    回傳 ContextPlan，其中 num_ctx 為能容納整個 prompt 的最小分級值
+    """
+    answer_reserve = min(answer_reserve, max_tokens // 4)
+    remaining = max_tokens - answer_reserve
+    remaining -= count_tokens(system_prompt) + 2 * MESSAGE_OVERHEAD
+    question_tokens = count_tokens(user_input)
+    if question_tokens > remaining:
+        user_input = truncate_to_tokens(user_input, remaining)
+        question_tokens = count_tokens(user_input)
+    remaining -= question_tokens
+
+    # 上傳檔案內容
+    doc_parts = []
+    truncated_documents = 0
+    for doc in documents:
+        doc_tokens = count_tokens(doc)
+        if doc_tokens <= remaining:
+            doc_parts.append(doc)
+            remaining -= doc_tokens
+        else:
+            truncated = truncate_to_tokens(doc, remaining)
+            truncated_documents += 1
+            if truncated:
+                doc_parts.append(truncated)
+                remaining -= count_tokens(truncated)
+    user_content = user_input
+    if doc_parts:
+        user_content = f"{user_input}\n\n用戶上傳的檔案：\n" + "\n\n".join(doc_parts)
+
+    # 圖片：保留最新的
+    per_image = tokens_per_image(model)
+    max_images = max(remaining // per_image, 0) if per_image else len(images)
+    kept_images = list(images)[-max_images:] if max_images else []
+    remaining -= len(kept_images) * per_image
+
+    # 滾動摘要（較舊的回合已由背景任務折疊進來）
+    summary_message = history.summary_message()
+    if summary_message:
+        cost = history.summary_tokens + MESSAGE_OVERHEAD
+        if cost <= remaining:
+            remaining -= cost
+        else:
+            summary_message = None
+
+    # 對話歷史：從最新往回放
+    history_messages = []
+    turns = history.turns
+    window = turns[-recent_turns:] if recent_turns else turns
+    for turn in reversed(window):
+        cost = turn.tokens + MESSAGE_OVERHEAD
+        if cost > remaining:
+            break
+        history_messages.append(turn.to_message())
+        remaining -= cost
+    history_messages.reverse()
+
+    # 語意檢索出的過往問答：有剩餘空間才放
+    kept_memories = []
+    for content, tokens in memories:
+        if tokens + MESSAGE_OVERHEAD > remaining:
+            continue
+        kept_memories.append(content)
+        remaining -= tokens + MESSAGE_OVERHEAD
+
+    user_message = {"role": "user", "content": user_content}
+    if kept_images:
+        user_message["images"] = kept_images
+    messages = [{"role": "system", "content": system_prompt}]
+    if summary_message:
+        messages.append(summary_message)
+    if kept_memories:
+        messages.append(format_memories(kept_memories))
+    messages += history_messages + [user_message]
+
+    prompt_tokens = max_tokens - answer_reserve - remaining
+    return ContextPlan(
+        messages,
+        prompt_tokens,
+        choose_num_ctx(prompt_tokens, answer_reserve, max_tokens),
+        dropped_turns=len(turns) - len(history_messages),
+        dropped_images=len(images) - len(kept_images),
+        truncated_documents=truncated_documents)
@@ -0,0 +1,292 @@
+import json
+import sqlite3
+import threading
+import time
+
+# 每個頻道的提問次數（counters 表），用來判斷圖片閒置了幾次提問
+QUESTION_COUNTER = "questions"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS turns (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    channel_id INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    tokens INTEGER NOT NULL,
+    timestamp REAL NOT NULL,
+    images TEXT NOT NULL DEFAULT '[]'
+);
+CREATE INDEX IF NOT EXISTS idx_turns_channel ON turns (channel_id, id);
+
+CREATE TABLE IF NOT EXISTS documents (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    channel_id INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    content TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_documents_channel ON documents (channel_id, id);
+
+CREATE TABLE IF NOT EXISTS images (
+    channel_id INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    source TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    caption TEXT NOT NULL DEFAULT '',
+    used_seq INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (channel_id, path)
+);
+CREATE INDEX IF NOT EXISTS idx_images_channel ON images (channel_id, created_at);
+
+CREATE TABLE IF NOT EXISTS summaries (
+    channel_id INTEGER PRIMARY KEY,
+    summary TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS memories (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    channel_id INTEGER NOT NULL,
+    turn_id INTEGER NOT NULL,
+    content TEXT NOT NULL,
+    tokens INTEGER NOT NULL,
+    embedding BLOB NOT NULL,
+    UNIQUE (channel_id, turn_id)
+);
+
+CREATE TABLE IF NOT EXISTS counters (
+    channel_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    value INTEGER NOT NULL,
+    PRIMARY KEY (channel_id, name)
+);
+"""
+
+
+class ConversationStore:
+    """
+    以 SQLite（WAL 模式）保存所有頻道的對話、摘要、長期記憶、文件、圖片與計數器
+    取代各頻道目錄下的 history / file_contents.json / idle_count.json
+    """
+
+    def __init__(self, path="bot_data.sqlite3"):
+        self.path = path
+        # 背景執行緒也會讀寫，所以共用連線並以 lock 保護
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(SCHEMA)
+            self._migrate()
+
+    def _migrate(self):
+        """為舊版資料庫補上新增的欄位"""
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(images)")}
+        if "caption" not in columns:
+            self._conn.execute("ALTER TABLE images ADD COLUMN caption TEXT NOT NULL DEFAULT ''")
+        if "used_seq" not in columns:
+            self._conn.execute("ALTER TABLE images ADD COLUMN used_seq INTEGER NOT NULL DEFAULT 0")
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(memories)")}
+        if "turn_id" not in columns:
+            # 舊版以時間戳記辨識記憶（浮點數可能重複），改以 user 回合的 row id 辨識；
+            # 對應的回合已被摘要折疊時以負數保留，不會和新的回合衝突，也早於所有留在歷史中的回合
+            self._conn.executescript("""
+                BEGIN;
+                ALTER TABLE memories RENAME TO memories_v1;
+                CREATE TABLE memories (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    channel_id INTEGER NOT NULL,
+                    turn_id INTEGER NOT NULL,
+                    content TEXT NOT NULL,
+                    tokens INTEGER NOT NULL,
+                    embedding BLOB NOT NULL,
+                    UNIQUE (channel_id, turn_id)
+                );
+                INSERT INTO memories (id, channel_id, turn_id, content, tokens, embedding)
+                    SELECT m.id, m.channel_id,
+                           COALESCE((SELECT t.id FROM turns t WHERE t.channel_id = m.channel_id
+                                     AND t.timestamp = m.timestamp AND t.role = 'user' ORDER BY t.id LIMIT 1), -m.id),
+                           m.content, m.tokens, m.embedding
+                    FROM memories_v1 m ORDER BY m.id;
+                DROP TABLE memories_v1;
+                COMMIT;
+            """)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def _transaction(self, statements):
+        """在同一個交易中執行多個 (sql, params)，回傳各個單筆敘述的 lastrowid"""
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                row_ids = []
+                for sql, params in statements:
+                    if isinstance(params, list):
+                        self._conn.executemany(sql, params)
+                        row_ids.append(None)
+                    else:
+                        row_ids.append(self._conn.execute(sql, params).lastrowid)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            return row_ids
+
+    # ---- 對話 ----
+    def load_turns(self, channel_id):
+        rows = self._execute(
+            "SELECT role, content, tokens, timestamp, images, id FROM turns WHERE channel_id = ? ORDER BY id",
+            (channel_id,))
+        return [
+            {"role": r[0], "content": r[1], "tokens": r[2], "timestamp": r[3], "images": json.loads(r[4]), "id": r[5]}
+            for r in rows
+        ]
+
+    def _turn_rows(self, channel_id, turns):
+        return [
+            (channel_id, t["role"], t["content"], t["tokens"], t["timestamp"], json.dumps(t.get("images") or []))
+            for t in turns
+        ]
+
+    def append_turns(self, channel_id, turns):
+        """新增回合，回傳各回合的 row id"""
+        return self._transaction([
+            ("INSERT INTO turns (channel_id, role, content, tokens, timestamp, images) VALUES (?, ?, ?, ?, ?, ?)", row)
+            for row in self._turn_rows(channel_id, turns)])
+
+    def replace_turns(self, channel_id, turns):
+        """以新的完整歷史取代頻道的對話（單一交易，不會留下一半的狀態）"""
+        self._transaction([
+            ("DELETE FROM turns WHERE channel_id = ?", (channel_id,)),
+            ("INSERT INTO turns (channel_id, role, content, tokens, timestamp, images) VALUES (?, ?, ?, ?, ?, ?)",
+             self._turn_rows(channel_id, turns)),
+        ])
+
+    def load_summary(self, channel_id):
+        rows = self._execute("SELECT summary FROM summaries WHERE channel_id = ?", (channel_id,))
+        return rows[0][0] if rows else ""
+
+    def fold_turns(self, channel_id, count, summary):
+        """刪除最舊的 count 個回合並更新滾動摘要（單一交易）"""
+        self._transaction([
+            ("DELETE FROM turns WHERE id IN "
+             "(SELECT id FROM turns WHERE channel_id = ? ORDER BY id LIMIT ?)", (channel_id, count)),
+            ("INSERT INTO summaries (channel_id, summary, updated_at) VALUES (?, ?, ?) "
+             "ON CONFLICT (channel_id) DO UPDATE SET summary = excluded.summary, updated_at = excluded.updated_at",
+             (channel_id, summary, time.time())),
+        ])
+
+    # ---- 長期記憶（每次問答一筆，以 user 回合的 row id 辨識，含 embedding，摘要折疊後仍保留） ----
+    def add_memory(self, channel_id, turn_id, content, tokens, embedding):
+        self._execute(
+            "INSERT OR IGNORE INTO memories (channel_id, turn_id, content, tokens, embedding) VALUES (?, ?, ?, ?, ?)",
+            (channel_id, turn_id, content, tokens, embedding))
+
+    def load_memories(self, channel_id):
+        """回傳 [(turn_id, content, tokens, embedding), ...]，依加入順序"""
+        return self._execute(
+            "SELECT turn_id, content, tokens, embedding FROM memories WHERE channel_id = ? ORDER BY id",
+            (channel_id,))
+
+    # ---- 上傳文件 ----
+    def add_document(self, channel_id, path, content):
+        self._execute(
+            "INSERT INTO documents (channel_id, path, content, created_at) VALUES (?, ?, ?, ?)",
+            (channel_id, path, content, time.time()))
+
+    def list_documents(self, channel_id):
+        """回傳 [(path, content), ...]，依上傳順序"""
+        return self._execute(
+            "SELECT path, content FROM documents WHERE channel_id = ? ORDER BY id", (channel_id,))
+
+    def clear_documents(self, channel_id):
+        self._execute("DELETE FROM documents WHERE channel_id = ?", (channel_id,))
+
+    # ---- 圖片 ----
+    def add_image(self, channel_id, path, source="upload", created_at=None, caption=""):
+        """登記圖片；used_seq 記錄登記當下的提問次數，之後每次被放進 prompt 時更新"""
+        self._execute(
+            "INSERT OR REPLACE INTO images (channel_id, path, source, created_at, caption, used_seq) "
+            "VALUES (?, ?, ?, ?, ?, COALESCE((SELECT value FROM counters WHERE channel_id = ? AND name = ?), 0))",
+            (channel_id, path, source, time.time() if created_at is None else created_at, caption,
+             channel_id, QUESTION_COUNTER))
+
+    def mark_images_used(self, channel_id, paths, seq):
+        """記錄圖片在第 seq 次提問時被使用"""
+        if paths:
+            self._transaction([("UPDATE images SET used_seq = ? WHERE channel_id = ? AND path = ?",
+                                [(seq, channel_id, path) for path in paths])])
+
+    def list_idle_images(self, channel_id, max_idle, source="upload"):
+        """回傳超過 max_idle 次提問沒有被使用的圖片路徑，最舊的在前"""
+        current = self.get_counter(channel_id, QUESTION_COUNTER)
+        rows = self._execute(
+            "SELECT path FROM images WHERE channel_id = ? AND source = ? AND used_seq < ? ORDER BY created_at, path",
+            (channel_id, source, current - max_idle))
+        return [r[0] for r in rows]
+
+    def list_images(self, channel_id, source=None, older_than=None):
+        """回傳圖片路徑，最舊的在前"""
+        sql = "SELECT path FROM images WHERE channel_id = ?"
+        params = [channel_id]
+        if source is not None:
+            sql += " AND source = ?"
+            params.append(source)
+        if older_than is not None:
+            sql += " AND created_at < ?"
+            params.append(older_than)
+        sql += " ORDER BY created_at, path"
+        return [r[0] for r in self._execute(sql, params)]
+
+    def list_image_records(self, channel_id):
+        """回傳 [(path, source, created_at, caption), ...]，最舊的在前"""
+        return self._execute(
+            "SELECT path, source, created_at, caption FROM images WHERE channel_id = ? ORDER BY created_at, path",
+            (channel_id,))
+
+    def remove_image(self, channel_id, path):
+        self._execute("DELETE FROM images WHERE channel_id = ? AND path = ?", (channel_id, path))
+
+    # ---- 計數器 ----
+    def get_counter(self, channel_id, name):
+        rows = self._execute(
+            "SELECT value FROM counters WHERE channel_id = ? AND name = ?", (channel_id, name))
+        return rows[0][0] if rows else 0
+
+    def set_counter(self, channel_id, name, value):
+        self._execute(
+            "INSERT INTO counters (channel_id, name, value) VALUES (?, ?, ?) "
+            "ON CONFLICT (channel_id, name) DO UPDATE SET value = excluded.value",
+            (channel_id, name, value))
+
+    def increment_counter(self, channel_id, name, delta=1):
+        rows = self._execute(
+            "INSERT INTO counters (channel_id, name, value) VALUES (?, ?, ?) "
+            "ON CONFLICT (channel_id, name) DO UPDATE SET value = value + excluded.value "
+            "RETURNING value",
+            (channel_id, name, delta))
+        return rows[0][0]
+
+    def list_channels(self):
+        """回傳資料庫中有任何紀錄的頻道 ID"""
+        rows = self._execute(
+            "SELECT channel_id FROM turns UNION SELECT channel_id FROM documents UNION SELECT channel_id FROM images")
+        return [r[0] for r in rows]
+
+    def clear_channel(self, channel_id):
+        """清除頻道的所有資料"""
+        self._transaction([
+            ("DELETE FROM turns WHERE channel_id = ?", (channel_id,)),
+            ("DELETE FROM summaries WHERE channel_id = ?", (channel_id,)),
+            ("DELETE FROM memories WHERE channel_id = ?", (channel_id,)),
+            ("DELETE FROM documents WHERE channel_id = ?", (channel_id,)),
+            ("DELETE FROM images WHERE channel_id = ?", (channel_id,)),
+            ("DELETE FROM counters WHERE channel_id = ?", (channel_id,)),
+        ])
@@ -0,0 +1,153 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+# 圖片路徑在快取中的佔位字串，取出時換成目標頻道的圖片目錄
+IMAGE_DIR_PLACEHOLDER = "{IMAGE_DIR}"
+
+
+def file_sha256(filepath, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(chunk_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+class ConversionCache:
+    """
+    以內容定址的文件轉換快取（所有頻道共用）：
+    key = SHA-256(檔案內容) + 轉換設定，每個 key 一個目錄：
+        meta.json   — 頁數、大小、最後使用時間
+        pages.json  — 每頁的 Markdown（圖片路徑以 {IMAGE_DIR} 表示）
+        images/     — 擷取出的圖片
+    總大小超過 max_bytes 時，依最後使用時間淘汰最舊的項目（LRU）
+    """
+
+    def __init__(self, root="conversion_cache", max_bytes=1 << 30):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._index = {}  # key -> {"size": int, "last_used": float}
+        os.makedirs(root, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self):
+        for key in os.listdir(self.root):
+            meta_path = os.path.join(self.root, key, "meta.json")
+            try:
+                with open(meta_path, "r", encoding="utf-8") as f:
+                    meta = json.load(f)
+                self._index[key] = {"size": meta["size"], "last_used": meta["last_used"]}
+            except (OSError, ValueError, KeyError):
+                # 寫入到一半中斷的項目
+                shutil.rmtree(os.path.join(self.root, key), ignore_errors=True)
+        print(f"[DEBUG] 文件轉換快取: {len(self._index)} 筆，共 {self.total_bytes() / 1e6:.1f} MB")
+
+    def total_bytes(self):
+        return sum(entry["size"] for entry in self._index.values())
+
+    @staticmethod
+    def make_key(filepath, settings, digest=None):
+        """digest 為已知的檔案 SHA-256（例如下載時已計算），省去重新讀檔"""
+        digest = digest or file_sha256(filepath)
+        return hashlib.sha256(f"{digest}|{settings}".encode("utf-8")).hexdigest()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.root, key)
+
+    def _write_meta(self, key, meta):
+        meta_path = os.path.join(self._entry_dir(key), "meta.json")
+        tmp_path = meta_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, meta_path)
+
+    def get(self, key, image_dir):
+        """
+        命中時把圖片複製到 image_dir，回傳 (每頁 Markdown 列表, 圖片路徑列表)；未命中回傳 None
+        """
+        with self._lock:
+            if key not in self._index:
+                return None
+            self._index[key]["last_used"] = time.time()
+            entry = dict(self._index[key])
+        entry_dir = self._entry_dir(key)
+        try:
+            with open(os.path.join(entry_dir, "pages.json"), "r", encoding="utf-8") as f:
+                pages = json.load(f)
+            images_dir = os.path.join(entry_dir, "images")
+            image_paths = []
+            if os.path.isdir(images_dir):
+                os.makedirs(image_dir, exist_ok=True)
+                for name in sorted(os.listdir(images_dir)):
+                    target = f"{image_dir}/{name}"
+                    shutil.copyfile(os.path.join(images_dir, name), target)
+                    image_paths.append(target)
+            self._write_meta(key, {"size": entry["size"], "last_used": entry["last_used"], "pages": len(pages)})
+        except (OSError, ValueError) as e:
+            print(f"[WARNING] 讀取文件轉換快取失敗，將重新轉換: {e}")
+            self._discard(key)
+            return None
+        return [page.replace(IMAGE_DIR_PLACEHOLDER, image_dir) for page in pages], image_paths
+
+    def put(self, key, pages, image_paths, image_dir):
+        """保存轉換結果；image_paths 為轉換時寫入 image_dir 的圖片"""
+        entry_dir = self._entry_dir(key)
+        tmp_dir = entry_dir + ".tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        try:
+            os.makedirs(os.path.join(tmp_dir, "images"))
+            for path in image_paths:
+                if os.path.exists(path):
+                    shutil.copyfile(path, os.path.join(tmp_dir, "images", os.path.basename(path)))
+            with open(os.path.join(tmp_dir, "pages.json"), "w", encoding="utf-8") as f:
+                json.dump([page.replace(image_dir, IMAGE_DIR_PLACEHOLDER) for page in pages], f, ensure_ascii=False)
+            now = time.time()
+            size = _dir_size(tmp_dir)
+            with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as f:
+                json.dump({"size": size, "last_used": now, "pages": len(pages)}, f)
+            with self._lock:
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                os.replace(tmp_dir, entry_dir)
+                self._index[key] = {"size": size, "last_used": now}
+        except OSError as e:
+            print(f"[WARNING] 寫入文件轉換快取失敗: {e}")
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+        self.evict()
+
+    def _discard(self, key):
+        with self._lock:
+            self._index.pop(key, None)
+            shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+
+    def evict(self):
+        """總大小超過上限時淘汰最久未使用的項目，回傳釋放的位元組數"""
+        freed = 0
+        with self._lock:
+            total = sum(entry["size"] for entry in self._index.values())
+            for key in sorted(self._index, key=lambda k: self._index[k]["last_used"]):
+                if total <= self.max_bytes:
+                    break
+                size = self._index.pop(key)["size"]
+                shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+                total -= size
+                freed += size
+        if freed:
+            print(f"[DEBUG] 文件轉換快取淘汰 {freed / 1e6:.1f} MB")
+        return freed
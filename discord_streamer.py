@@ -0,0 +1,135 @@
+import asyncio
+import time
+import discord
+
+# Discord 單則訊息長度上限
+DISCORD_MESSAGE_LIMIT = 2000
+
+
+class DiscordStreamRenderer:
+    """
+    將串流中的回應增量渲染到 Discord 訊息：
+    - 只編輯內容有變動的段落（通常只有最後一段）
+    - 更新速度超過頻道 rate limit 時合併成一次編輯
+    - 依 token 速率與 429 回饋自動調整刷新間隔
+    """
+
+    def __init__(self, channel, messages, min_interval=0.5, max_interval=8.0, min_delta_chars=40,
+                 max_final_attempts=6):
+        self.channel = channel
+        self.messages = messages            # 已送出的訊息（第一則為佔位訊息）
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.min_delta_chars = min_delta_chars
+        self.max_final_attempts = max_final_attempts
+        self.interval = 1.0                 # 目前的刷新間隔（秒）
+        self._rendered = [None] * len(messages)  # 每則訊息目前顯示的內容
+        self._text = ""
+        self._dirty = asyncio.Event()
+        self._task = None
+        self._last_flush = 0.0
+        # token 速率估計（字元/秒，指數移動平均）
+        self._char_rate = 0.0
+        self._last_update = None
+        self._last_length = 0
+        self.edit_count = 0
+        self.rate_limited_count = 0
+
+    def update(self, text):
+        """提交最新的累積內容，不等待 API；實際編輯由背景任務合併送出"""
+        now = time.monotonic()
+        if self._last_update is not None and now > self._last_update:
+            rate = max(len(text) - self._last_length, 0) / (now - self._last_update)
+            self._char_rate = rate if self._char_rate == 0 else 0.7 * self._char_rate + 0.3 * rate
+        self._last_update = now
+        self._last_length = len(text)
+
+        self._text = text
+        self._dirty.set()
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def finish(self, text=None):
+        """停止背景刷新並送出最終內容；遇到 rate limit 或送出失敗時依刷新間隔重試，直到每一段都顯示完成"""
+        if text is not None:
+            self._text = text
+        await self.close()
+        for _ in range(self.max_final_attempts):
+            if await self._flush():
+                return
+            await asyncio.sleep(self.interval)
+        print(f"[WARNING] 最終回應在 {self.max_final_attempts} 次嘗試後仍未完整顯示")
+
+    async def close(self):
+        """停止背景刷新（不送出剩餘內容，用於錯誤處理）"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await self._dirty.wait()
+            wait = self.interval - (time.monotonic() - self._last_flush)
+            if wait > 0:
+                # 等待期間到達的更新都會合併進同一次編輯
+                await asyncio.sleep(wait)
+            self._dirty.clear()
+            await self._flush()
+
+    async def _flush(self):
+        """送出有變動的段落，全部段落都已顯示時回傳 True"""
+        text = self._text
+        if not text:
+            return True
+        complete = True
+        segments = [text[i:i + DISCORD_MESSAGE_LIMIT] for i in range(0, len(text), DISCORD_MESSAGE_LIMIT)]
+        slow = False
+        for idx, seg in enumerate(segments):
+            if idx < len(self._rendered) and self._rendered[idx] == seg:
+                continue  # 內容沒變，不必呼叫 API
+            start = time.monotonic()
+            try:
+                if idx < len(self.messages):
+                    await self.messages[idx].edit(content=seg)
+                else:
+                    self.messages.append(await self.channel.send(seg))
+                    self._rendered.append(None)
+                self._rendered[idx] = seg
+                self.edit_count += 1
+            except discord.HTTPException as e:
+                if e.status == 429:
+                    self.rate_limited_count += 1
+                    self._backoff(getattr(e, "retry_after", None))
+                    self._dirty.set()  # 稍後重試剩下的段落
+                    self._last_flush = time.monotonic()
+                    return False
+                print(f"[DEBUG] 編輯訊息失敗: {e}")
+                complete = False
+                if idx >= len(self.messages):
+                    # 新段落送出失敗：後面的段落不能先送，否則訊息與段落的順序會錯開
+                    self._dirty.set()
+                    break
+            # discord.py 碰到 bucket 用盡會在內部等待，耗時過長代表已觸及 rate limit
+            if time.monotonic() - start > self.interval:
+                slow = True
+        self._last_flush = time.monotonic()
+        if slow:
+            self._backoff()
+        else:
+            self._relax()
+        return complete
+
+    def _backoff(self, retry_after=None):
+        self.interval = min(self.max_interval, max(self.interval * 2, retry_after or 0))
+        print(f"[DEBUG] 觸及 Discord rate limit，刷新間隔調整為 {self.interval:.1f}s")
+
+    def _relax(self):
+        interval = max(self.min_interval, self.interval * 0.9)
+        # 生成速度很慢時拉長間隔，避免每次只多幾個字就編輯一次
+        if self._char_rate > 0:
+            interval = max(interval, self.min_delta_chars / self._char_rate)
+        self.interval = min(self.max_interval, interval)
@@ -0,0 +1,108 @@
+import asyncio
+import re
+import numpy as np
+from token_counter import count_tokens
+
+# 以頁首（"page N:"）與 Markdown 標題作為段落邊界
+_SECTION_RE = re.compile(r'^(?=page \d+:$|#{1,6} )', re.M)
+
+
+def _split_oversized(text, max_tokens):
+    """把超過上限的段落依空行切開，單一段落仍太長時依比例切字"""
+    pieces = []
+    for paragraph in text.split("\n\n"):
+        if not paragraph.strip():
+            continue
+        tokens = count_tokens(paragraph)
+        if tokens <= max_tokens:
+            pieces.append(paragraph)
+            continue
+        step = max(int(len(paragraph) * max_tokens / tokens), 1)
+        pieces.extend(paragraph[i:i + step] for i in range(0, len(paragraph), step))
+    return pieces
+
+
+def split_into_chunks(text, max_tokens=400):
+    """
+    依頁面與標題切分文件，再把相鄰的小段落合併到 max_tokens 以內
+    回傳 chunk 文字列表（保持原文順序）
+    """
+    chunks = []
+    current, current_tokens = [], 0
+    for section in _SECTION_RE.split(text):
+        if not section.strip():
+            continue
+        pieces = [section] if count_tokens(section) <= max_tokens else _split_oversized(section, max_tokens)
+        for piece in pieces:
+            tokens = count_tokens(piece)
+            if current and current_tokens + tokens > max_tokens:
+                chunks.append("\n".join(current))
+                current, current_tokens = [], 0
+            current.append(piece.strip("\n"))
+            current_tokens += tokens
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+
+async def embed_texts(client, model, texts, batch_size=32):
+    """透過 Ollama embeddings 端點取得正規化後的向量矩陣（每列一段文字）"""
+    vectors = []
+    for start in range(0, len(texts), batch_size):
+        response = await client.embed(model=model, input=texts[start:start + batch_size])
+        vectors.extend(response["embeddings"])
+    matrix = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+class DocumentIndex:
+    """
+    單一頻道上傳文件的向量索引：
+    - 文件切成 chunk 後透過 Ollama embeddings 端點取得向量（正規化後存成 NumPy 矩陣）
+    - 查詢時以 cosine 相似度取前 k 個 chunk，依原文順序回傳
+    """
+
+    def __init__(self, client, embed_model, chunk_tokens=400, top_k=6, batch_size=32):
+        self.client = client
+        self.embed_model = embed_model
+        self.chunk_tokens = chunk_tokens
+        self.top_k = top_k
+        self.batch_size = batch_size
+        self._chunks = []  # [(來源, chunk 文字), ...]
+        self._vectors = None
+        self._sources = set()
+        self._lock = asyncio.Lock()
+
+    def __len__(self):
+        return len(self._chunks)
+
+    def __contains__(self, source):
+        return source in self._sources
+
+    async def _embed(self, texts):
+        return await embed_texts(self.client, self.embed_model, texts, self.batch_size)
+
+    async def add(self, source, text):
+        """切分並索引一份文件（同一來源只索引一次；同時加入同一來源時，後到的等待前一次完成）"""
+        async with self._lock:
+            if source in self._sources:
+                return
+            # 切分時會計算每一段的 token 數，長文件放到執行緒中處理
+            chunks = await asyncio.to_thread(split_into_chunks, text, self.chunk_tokens)
+            if chunks:
+                vectors = await self._embed(chunks)
+                self._vectors = vectors if self._vectors is None else np.vstack([self._vectors, vectors])
+                self._chunks.extend((source, chunk) for chunk in chunks)
+            self._sources.add(source)
+        print(f"[DEBUG] 已索引文件 {source}：{len(chunks)} 個段落")
+
+    async def search(self, query, top_k=None):
+        """回傳與問題最相關的 [(來源, chunk 文字), ...]，依原文順序排列"""
+        if not self._chunks:
+            return []
+        k = min(top_k or self.top_k, len(self._chunks))
+        query_vector = (await self._embed([query]))[0]
+        scores = self._vectors @ query_vector
+        best = np.argpartition(-scores, k - 1)[:k]
+        return [self._chunks[i] for i in sorted(best)]
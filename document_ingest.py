@@ -0,0 +1,187 @@
+import asyncio
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# 可由 pymupdf4llm 轉換的文件格式（.doc/.docx 需要 pymupdf.pro）
+DOCUMENT_EXTENSIONS = ('.pdf', '.doc', '.docx')
+# 轉換設定，與檔案內容一起組成轉換快取的 key；修改轉換參數時需一併更新
+CONVERTER_SETTINGS = "pymupdf4llm|page_chunks|jpg|v1"
+# Markdown 圖片語法，對應寫入 pdf_images 的圖片路徑
+_IMAGE_LINK_RE = re.compile(r'!\[[^\]]*\]\(([^)]+)\)')
+
+
+class IngestTimeoutError(Exception):
+    """文件轉換超過時間限制"""
+
+
+# ---- 以下函式在 worker process 中執行，必須是模組層級函式才能被 pickle ----
+def _init_worker():
+    """worker 啟動時預先載入轉換套件，之後的轉換不用再付 import 成本"""
+    import pymupdf4llm  # noqa: F401
+    try:
+        import pymupdf.pro
+        pymupdf.pro.unlock()
+    except ImportError:
+        pass
+
+
+def _ping():
+    return os.getpid()
+
+
+def count_pages(filepath):
+    import pymupdf
+    with pymupdf.open(filepath) as doc:
+        return doc.page_count
+
+
+def convert_pages(filepath, image_dir, pages):
+    """轉換指定頁面（0 起算）為每頁一段的 Markdown 列表，圖片寫入 image_dir"""
+    import pymupdf4llm
+    chunks = pymupdf4llm.to_markdown(
+        doc=filepath,
+        pages=pages,
+        write_images=True,
+        image_format='jpg',
+        image_path=image_dir,
+        page_chunks=True
+    )
+    return [f'page {page["metadata"]["page"]}:\n{page["text"]}' for page in chunks]
+
+
+def read_text_file(filepath):
+    with open(filepath, 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+class DocumentIngestor:
+    """
+    在常駐的 process pool 中轉換上傳的文件，不阻塞 event loop：
+    - 大型 PDF 依頁數切成多個批次，分散到多個核心並可回報進度
+    - 同一則訊息的多個附件可同時轉換
+    - 每個檔案有時間上限，逾時會終止卡住的 worker 並重建 pool
+      （無法只終止該檔案的 worker：同時在轉換的其他檔案的批次也會中斷並重新提交一次，且它們的計時不會重設）
+    - 呼叫端的 task 被取消時，尚未開始的批次也會一併取消
+    - 有 cache（ConversionCache）時，相同內容的檔案直接取用先前的轉換結果
+    """
+
+    def __init__(self, max_workers=None, timeout=300, pages_per_batch=20, cache=None):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.timeout = timeout
+        self.pages_per_batch = pages_per_batch
+        self.cache = cache
+        self._executor = None
+
+    def _pool(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers, initializer=_init_worker)
+        return self._executor
+
+    def warm_up(self):
+        """預先啟動 worker，避免第一個上傳的檔案等待 process 啟動與套件載入"""
+        pool = self._pool()
+        for _ in range(self.max_workers):
+            pool.submit(_ping)
+
+    def _reset(self, pool):
+        """終止 pool 中所有 worker（包含卡住的轉換），下一次提交時重建"""
+        if self._executor is pool:
+            self._executor = None
+        # ProcessPoolExecutor 沒有公開的終止方法，直接結束其 worker process
+        processes = list((getattr(pool, "_processes", None) or {}).values())
+        pool.shutdown(wait=False, cancel_futures=True)
+        for process in processes:
+            try:
+                process.kill()
+            except Exception:
+                pass
+        print(f"[WARNING] 已重建文件轉換 pool（終止 {len(processes)} 個 worker）")
+
+    async def _run(self, fn, *args):
+        # pool 可能因其他檔案逾時被重建，此時重新提交一次
+        for attempt in range(2):
+            pool = self._pool()
+            try:
+                return await asyncio.wrap_future(pool.submit(fn, *args))
+            except BrokenProcessPool:
+                self._reset(pool)
+                if attempt:
+                    raise
+
+    async def convert(self, filepath, on_progress=None, sha256=None):
+        """
+        轉換單一文件，回傳 (文字內容, 擷取出的圖片路徑列表)
+        on_progress(done_pages, total_pages) 為 async callback，每完成一個批次呼叫一次
+        sha256 為已知的檔案雜湊（下載時計算），用於轉換快取
+        """
+        ext = os.path.splitext(filepath)[1].lower()
+        if ext == '.txt':
+            try:
+                content = await asyncio.to_thread(read_text_file, filepath)
+            except UnicodeDecodeError:
+                return "[File encoding error]", []
+            return (content if content.strip() else "[Empty file]"), []
+        if ext not in DOCUMENT_EXTENSIONS:
+            return "[Unsupported file type]", []
+
+        pool = self._pool()
+        try:
+            return await asyncio.wait_for(
+                self._convert_document(os.path.abspath(filepath), on_progress, sha256), self.timeout)
+        except asyncio.TimeoutError:
+            self._reset(pool)
+            raise IngestTimeoutError(f"轉換超過 {self.timeout} 秒")
+
+    async def _convert_document(self, filepath, on_progress, sha256=None):
+        channel_dir = os.path.dirname(filepath)
+        channel_id = os.path.basename(channel_dir)  # 頻道目錄名稱就是頻道 ID
+        image_dir = channel_id + "/pdf_images"  # 相對路徑，圖片寫在頻道目錄下
+
+        key = None
+        if self.cache is not None:
+            key = await asyncio.to_thread(self.cache.make_key, filepath, CONVERTER_SETTINGS, sha256)
+            cached = await asyncio.to_thread(self.cache.get, key, image_dir)
+            if cached is not None:
+                pages, image_paths = cached
+                print(f"[DEBUG] 文件轉換快取命中: {filepath}")
+                if on_progress is not None:
+                    await on_progress(len(pages), len(pages))
+                md_text = "".join(pages)
+                return (md_text if md_text.strip() else "[Empty file]"), image_paths
+
+        total = await self._run(count_pages, filepath)
+        batches = [
+            list(range(start, min(start + self.pages_per_batch, total)))
+            for start in range(0, total, self.pages_per_batch)
+        ]
+        done = 0
+
+        async def run_batch(pages):
+            nonlocal done
+            texts = await self._run(convert_pages, filepath, image_dir, pages)
+            done += len(pages)
+            if on_progress is not None:
+                await on_progress(done, total)
+            return texts
+
+        # 批次結果依頁序串接；任一批次失敗或被取消時，其餘批次一併取消
+        tasks = [asyncio.ensure_future(run_batch(pages)) for pages in batches]
+        try:
+            batch_texts = await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        pages = [text for texts in batch_texts for text in texts]
+        md_text = "".join(pages)
+        image_paths = [path.replace('\\', '/') for path in _IMAGE_LINK_RE.findall(md_text)]
+        if key is not None:
+            await asyncio.to_thread(self.cache.put, key, pages, image_paths, image_dir)
+        return (md_text if md_text.strip() else "[Empty file]"), image_paths
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,146 @@
+import hashlib
+import os
+import threading
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp')
+DOCUMENT_EXTENSIONS = ('.txt', '.pdf', '.doc', '.docx')
+KINDS = ("image", "pdf_image", "document", "other")
+
+
+def _normalize(path):
+    """統一成相對於工作目錄、以 / 分隔的路徑，作為 manifest 的 key"""
+    return os.path.relpath(os.path.abspath(path)).replace('\\', '/')
+
+
+def classify(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext in IMAGE_EXTENSIONS:
+        return "pdf_image" if "/pdf_images/" in path else "image"
+    if ext in DOCUMENT_EXTENSIONS:
+        return "document"
+    return "other"
+
+
+class FileEntry:
+    """manifest 中的單一檔案"""
+
+    __slots__ = ("path", "kind", "size", "sha256", "mtime")
+
+    def __init__(self, path, kind, size, mtime, sha256=None):
+        self.path = path
+        self.kind = kind
+        self.size = size
+        self.mtime = mtime
+        self.sha256 = sha256
+
+
+class ChannelManifest:
+    """
+    單一頻道目錄的檔案索引（路徑、類型、大小、雜湊、修改時間）：
+    檔案存入或刪除時同步更新，依類型列出檔案不需再掃描目錄
+    第一次使用時從磁碟建立一次
+    """
+
+    def __init__(self, channel_dir):
+        self.channel_dir = channel_dir
+        self._entries = {}  # path -> FileEntry
+        self._by_kind = {kind: {} for kind in KINDS}  # kind -> {path: FileEntry}（依加入順序）
+        self.total_bytes = 0
+        self._lock = threading.Lock()
+        self._rebuild()
+
+    def _rebuild(self):
+        for directory in (self.channel_dir, os.path.join(self.channel_dir, "pdf_images")):
+            if not os.path.isdir(directory):
+                continue
+            entries = sorted(
+                (entry for entry in os.scandir(directory) if entry.is_file() and not entry.name.endswith(".part")),
+                key=lambda entry: entry.stat().st_mtime)
+            for entry in entries:
+                self.add(entry.path)
+
+    def add(self, path, sha256=None):
+        """登記（或更新）一個已寫入磁碟的檔案，回傳 FileEntry"""
+        key = _normalize(path)
+        stat = os.stat(path)
+        entry = FileEntry(key, classify(key), stat.st_size, stat.st_mtime, sha256)
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = entry
+            self._by_kind[entry.kind][key] = entry
+            self.total_bytes += entry.size
+        return entry
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            del self._by_kind[entry.kind][key]
+            self.total_bytes -= entry.size
+        return entry
+
+    def get(self, path):
+        return self._entries.get(_normalize(path))
+
+    def __contains__(self, path):
+        return _normalize(path) in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def files(self, kind):
+        """依加入順序（最舊的在前）列出某類型的檔案"""
+        with self._lock:
+            return list(self._by_kind[kind].values())
+
+    def images(self):
+        return self.files("image") + self.files("pdf_image")
+
+    def documents(self):
+        return self.files("document")
+
+    def sha256(self, path):
+        """回傳檔案雜湊（未知時計算一次並記錄）"""
+        entry = self.get(path)
+        if entry is not None and entry.sha256:
+            return entry.sha256
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        if entry is not None:
+            entry.sha256 = digest.hexdigest()
+        return digest.hexdigest()
+
+    def remove(self, path):
+        """刪除檔案並移出 manifest，回傳釋放的位元組數"""
+        key = _normalize(path)
+        with self._lock:
+            entry = self._discard(key)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        return entry.size if entry is not None else 0
+
+    def clear(self):
+        """刪除頻道目錄下所有登記的檔案，回傳釋放的位元組數"""
+        freed = 0
+        for entry in list(self._entries.values()):
+            freed += self.remove(entry.path)
+        return freed
+
+
+class ManifestRegistry:
+    """頻道 ID -> ChannelManifest，首次使用時從磁碟建立"""
+
+    def __init__(self):
+        self._manifests = {}
+        self._lock = threading.Lock()
+
+    def get(self, channel_id):
+        with self._lock:
+            manifest = self._manifests.get(channel_id)
+            if manifest is None:
+                manifest = ChannelManifest(str(channel_id))
+                self._manifests[channel_id] = manifest
+            return manifest
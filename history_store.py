@@ -0,0 +1,129 @@
+import time
+from token_counter import count_tokens
+
+# history.json 的結構版本；舊版為 {"history": "Human: ...\nAI: ..."} 字串
+HISTORY_FORMAT_VERSION = 2
+
+
+class Turn:
+    """單一對話回合（一則訊息）"""
+
+    __slots__ = ("role", "content", "tokens", "timestamp", "images", "id")
+
+    def __init__(self, role, content, tokens=None, timestamp=None, images=None, id=None):
+        self.role = role
+        self.content = content
+        # token 數在建立時計算一次並保存，總數由 ConversationHistory 累加
+        self.tokens = count_tokens(content) if tokens is None else tokens
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self.images = list(images) if images else []
+        # 資料庫 turns 表的 row id，寫入資料庫後才有值
+        self.id = id
+
+    def to_message(self):
+        """轉成 Ollama messages 格式（歷史圖片只保留引用，不重送）"""
+        return {"role": self.role, "content": self.content}
+
+    def to_dict(self):
+        return {
+            "role": self.role,
+            "content": self.content,
+            "tokens": self.tokens,
+            "timestamp": self.timestamp,
+            "images": self.images,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            data["role"],
+            data.get("content", ""),
+            tokens=data.get("tokens"),
+            timestamp=data.get("timestamp"),
+            images=data.get("images"),
+            id=data.get("id"))
+
+
+class ConversationHistory:
+    """
+    頻道的對話歷史：較舊的回合折疊成滾動摘要，其餘為依序排列的 Turn 列表
+    token 總數（不含摘要）隨新增累加
+    """
+
+    def __init__(self, turns=None, summary=""):
+        self.turns = []
+        self.total_tokens = 0
+        self.summary = summary
+        self.summary_tokens = count_tokens(summary)
+        for turn in turns or []:
+            self.append_turn(turn)
+
+    def __len__(self):
+        return len(self.turns)
+
+    def append_turn(self, turn):
+        self.turns.append(turn)
+        self.total_tokens += turn.tokens
+        return turn
+
+    def append(self, role, content, images=None):
+        return self.append_turn(Turn(role, content, images=images))
+
+    def add_exchange(self, user_input, bot_response, images=None):
+        """記錄一次問答"""
+        self.append("user", user_input, images=images)
+        self.append("assistant", bot_response)
+
+    def summary_message(self):
+        """滾動摘要對應的 system 訊息（沒有摘要時回傳 None）"""
+        if not self.summary:
+            return None
+        return {"role": "system", "content": f"先前對話摘要：\n{self.summary}"}
+
+    def to_messages(self):
+        messages = [turn.to_message() for turn in self.turns]
+        summary = self.summary_message()
+        return [summary] + messages if summary else messages
+
+    def fold(self, count, summary):
+        """把最舊的 count 個回合折疊進新的摘要"""
+        folded = self.turns[:count]
+        self.turns = self.turns[count:]
+        self.total_tokens -= sum(t.tokens for t in folded)
+        self.summary = summary
+        self.summary_tokens = count_tokens(summary)
+
+    def clear(self):
+        self.turns = []
+        self.total_tokens = 0
+        self.summary = ""
+        self.summary_tokens = 0
+
+    def to_dict(self):
+        return {"version": HISTORY_FORMAT_VERSION, "turns": [t.to_dict() for t in self.turns]}
+
+    @classmethod
+    def from_dict(cls, data):
+        """讀取 history.json 內容，自動遷移舊版字串格式"""
+        if "turns" in data:
+            return cls([Turn.from_dict(t) for t in data["turns"]])
+        return cls(parse_legacy_history(data.get("history", "")))
+
+
+def parse_legacy_history(history_content):
+    """將舊版 LangChain 緩衝字串（"Human: ...\nAI: ..."）轉成 Turn 列表，只在遷移時執行一次"""
+    turns = []
+    if not history_content:
+        return turns
+    for conv in history_content.split("Human: "):
+        if not conv.strip():
+            continue
+        parts = conv.split("AI: ", 1)
+        if len(parts) != 2:
+            continue
+        user_input, ai_response = parts[0].strip(), parts[1].strip()
+        if user_input:
+            turns.append(Turn("user", user_input))
+        if ai_response:
+            turns.append(Turn("assistant", ai_response))
+    return turns
@@ -0,0 +1,112 @@
+import codecs
+import re
+
+try:
+    import lxml.html
+    from lxml import etree
+except ImportError:  # 沒有 lxml 時改用 BeautifulSoup
+    lxml = None
+
+# 不含正文的元素
+# 不可包含 form：ASP.NET WebForms 網站（許多政府、學校網站）整頁內容都包在 <form id="aspnetForm"> 中，
+# 只移除表單中的下拉選單選項
+SKIP_TAGS = ('script', 'style', 'noscript', 'template', 'svg', 'iframe', 'select',
+             'meta', 'link', 'header', 'footer', 'nav', 'aside')
+# 區塊元素：前後換行
+BLOCK_TAGS = {'p', 'div', 'section', 'article', 'main', 'li', 'ul', 'ol', 'table', 'tr', 'td', 'th',
+              'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'pre', 'blockquote', 'br', 'dd', 'dt'}
+# 優先作為正文的容器
+MAIN_CONTENT_XPATH = '//article | //main | //*[@role="main"]'
+
+_CHARSET_RE = re.compile(rb'<meta[^>]+charset=["\']?([\w-]+)', re.I)
+
+
+def _known_encoding(name):
+    """Python 認得的編碼名稱才回傳，否則回傳 None（網站常宣告錯誤或不存在的 charset）"""
+    try:
+        return codecs.lookup(name).name
+    except (LookupError, TypeError, ValueError):
+        return None
+
+
+def sniff_encoding(raw, header_encoding=None):
+    """依 HTTP 標頭或 <meta charset> 判斷編碼，找不到或無法辨識時使用 utf-8"""
+    if header_encoding:
+        encoding = _known_encoding(header_encoding)
+        if encoding:
+            return encoding
+    match = _CHARSET_RE.search(raw[:4096])
+    if match:
+        encoding = _known_encoding(match.group(1).decode("ascii", errors="replace"))
+        if encoding:
+            return encoding
+    return "utf-8"
+
+
+def _collect(element, parts, budget):
+    """依文件順序收集文字，累積超過 budget 字元後停止，回傳收集的字元數"""
+    total = 0
+    for node in element.iter():
+        # 註解、處理指令只取 tail
+        text = node.text if isinstance(node.tag, str) else None
+        if node.tag in BLOCK_TAGS:
+            parts.append("\n")
+        for piece in (text, node.tail if node is not element else None):
+            if piece and piece.strip():
+                parts.append(piece)
+                total += len(piece)
+        if total >= budget:
+            break
+    return total
+
+
+def _extract_lxml(html, max_chars):
+    root = lxml.html.fromstring(html)
+    etree.strip_elements(root, *SKIP_TAGS, with_tail=False)
+    candidates = root.xpath(MAIN_CONTENT_XPATH)
+    # 巢狀的容器（例如 <main> 裡的 <article>）只取最外層，正文太少的（只是版面外框）略過
+    containers = [c for c in candidates
+                  if not any(a in candidates for a in c.iterancestors()) and len(c.text_content()) > 200]
+    if not containers:
+        body = root.find('body')
+        containers = [body if body is not None else root]
+    parts, remaining = [], max_chars
+    for container in containers:
+        remaining -= _collect(container, parts, remaining)
+        if remaining <= 0:
+            break
+    return "".join(parts)
+
+
+def _extract_soup(html, max_chars):
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html, 'html.parser')
+    for tag in soup(list(SKIP_TAGS)):
+        tag.decompose()
+    container = soup.find(['article', 'main']) or soup.body or soup
+    parts, total = [], 0
+    for text in container.stripped_strings:
+        parts.append(text)
+        total += len(text)
+        if total >= max_chars:
+            break
+    return "\n".join(parts)
+
+
+def extract_text(html, max_chars=20000):
+    """
+    從 HTML 擷取正文文字（最多約 max_chars 字元）：
+    有 lxml 時以 lxml 解析並優先取 <article>/<main>，取到足夠文字就停止；否則使用 BeautifulSoup
+    """
+    if not html or not html.strip():
+        return ""
+    if lxml is not None:
+        try:
+            text = _extract_lxml(html, max_chars)
+        except (etree.ParserError, ValueError):
+            text = _extract_soup(html, max_chars)
+    else:
+        text = _extract_soup(html, max_chars)
+    # 只對截斷後的文字整理一次空白
+    lines = (" ".join(line.split()) for line in text[:max_chars].splitlines())
+    return "\n".join(line for line in lines if line)
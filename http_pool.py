@@ -0,0 +1,66 @@
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# 未指定 timeout 時的預設值（連線, 讀取），避免請求無限期卡住工具執行緒
+DEFAULT_TIMEOUT = (5, 30)
+DEFAULT_HEADERS = {"User-Agent": "Mozilla/5.0"}
+
+
+def make_session(pool_connections=16, pool_maxsize=8, retries=3, backoff_factor=0.5):
+    """
+    建立共用連線池的 Session：
+    - keep-alive，同一主機的連線（含 TLS）重複使用
+    - 每個主機最多 pool_maxsize 條連線，超過時等待（pool_block）
+    - 連線失敗與 429/5xx 以指數退避重試（只對 GET/HEAD 依狀態碼重試，POST 只重試連線錯誤）
+    """
+    retry = Retry(
+        total=retries,
+        connect=retries,
+        read=0,
+        backoff_factor=backoff_factor,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset(["GET", "HEAD"]),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+                          max_retries=retry, pool_block=True)
+    session = requests.Session()
+    session.headers.update(DEFAULT_HEADERS)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+_session = None
+_lock = threading.Lock()
+
+
+def get_session():
+    """回傳全域共用的 Session（第一次使用時建立）"""
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                _session = make_session()
+    return _session
+
+
+def get(url, **kwargs):
+    kwargs.setdefault("timeout", DEFAULT_TIMEOUT)
+    return get_session().get(url, **kwargs)
+
+
+def post(url, **kwargs):
+    kwargs.setdefault("timeout", DEFAULT_TIMEOUT)
+    return get_session().post(url, **kwargs)
+
+
+def close():
+    global _session
+    with _lock:
+        if _session is not None:
+            _session.close()
+            _session = None
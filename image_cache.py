@@ -0,0 +1,171 @@
+import asyncio
+import base64
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from io import BytesIO
+from PIL import Image
+
+# 各視覺模型的輸入解析度（長邊像素，依模型名稱前綴比對），超過的部分模型端也會縮小
+IMAGE_INPUT_SIZE = {
+    "gemma3": 896,
+    "llama3.2-vision": 1120,
+    "mistral-small3.1": 1540,
+}
+DEFAULT_IMAGE_INPUT_SIZE = 1024
+JPEG_QUALITY = 85
+
+
+def input_size(model):
+    for prefix, size in IMAGE_INPUT_SIZE.items():
+        if model.startswith(prefix):
+            return size
+    return DEFAULT_IMAGE_INPUT_SIZE
+
+
+def _resize_and_encode(path, max_side):
+    """縮小到 max_side 以內並轉成 JPEG，回傳 bytes"""
+    with Image.open(path) as img:
+        if getattr(img, "is_animated", False):
+            img.seek(0)
+        img = img.convert("RGB")
+        img.thumbnail((max_side, max_side), Image.LANCZOS)
+        buffered = BytesIO()
+        img.save(buffered, format="JPEG", quality=JPEG_QUALITY, optimize=True)
+        return buffered.getvalue()
+
+
+class ImageCache:
+    """
+    視覺模型的圖片前處理快取：
+    - 每張圖片只縮小、重新編碼一次（依模型輸入解析度），結果以 base64 字串傳給 Ollama
+    - key = SHA-256(原始檔內容) + 目標尺寸；記憶體中保留最近使用的結果，磁碟上保存編碼後的 JPEG
+    - 原始檔的雜湊依 (路徑, 修改時間, 大小) 記錄，檔案未變動時不重新讀取
+    - 磁碟上的總大小超過 max_disk_bytes 時淘汰最久未使用的 JPEG（使用時間記在檔案的修改時間，重新啟動後仍有效）
+    """
+
+    def __init__(self, root="image_cache", max_memory_bytes=64 * 1024 * 1024, max_disk_bytes=512 * 1024 * 1024):
+        self.root = root
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()  # key -> base64 字串
+        self._memory_bytes = 0
+        self._hashes = {}  # path -> ((mtime, size), sha256)
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self._disk = {}  # 檔名 -> [大小, 最後使用時間]
+        self._disk_bytes = 0
+        for entry in os.scandir(root):
+            if entry.name.endswith(".tmp"):
+                os.remove(entry.path)  # 上次寫到一半的檔案
+            elif entry.is_file():
+                stat = entry.stat()
+                self._disk[entry.name] = [stat.st_size, stat.st_mtime]
+                self._disk_bytes += stat.st_size
+        self.evict()
+
+    def _file_hash(self, path):
+        stat = os.stat(path)
+        signature = (stat.st_mtime, stat.st_size)
+        cached = self._hashes.get(path)
+        if cached and cached[0] == signature:
+            return cached[1]
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        self._hashes[path] = (signature, digest.hexdigest())
+        return digest.hexdigest()
+
+    def _remember(self, key, payload):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return
+            self._memory[key] = payload
+            self._memory_bytes += len(payload)
+            while self._memory_bytes > self.max_memory_bytes and len(self._memory) > 1:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= len(evicted)
+
+    def encode(self, path, max_side):
+        """回傳縮小後圖片的 base64 字串（同步，會讀檔與運算，請在執行緒中呼叫）"""
+        key = f"{self._file_hash(path)}_{max_side}"
+        with self._lock:
+            payload = self._memory.get(key)
+            if payload is not None:
+                self._memory.move_to_end(key)
+                return payload
+
+        name = key + ".jpg"
+        disk_path = os.path.join(self.root, name)
+        try:
+            with open(disk_path, "rb") as f:
+                data = f.read()
+            self._touch(name, disk_path)
+        except FileNotFoundError:
+            data = _resize_and_encode(path, max_side)
+            tmp_path = disk_path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, disk_path)
+            print(f"[DEBUG] 已縮小圖片 {path}：{os.path.getsize(path) / 1e3:.0f} KB -> {len(data) / 1e3:.0f} KB")
+            with self._lock:
+                old = self._disk.get(name)
+                if old is not None:
+                    self._disk_bytes -= old[0]
+                self._disk[name] = [len(data), time.time()]
+                self._disk_bytes += len(data)
+            self.evict()
+        payload = base64.b64encode(data).decode("ascii")
+        self._remember(key, payload)
+        return payload
+
+    def _touch(self, name, disk_path):
+        now = time.time()
+        with self._lock:
+            entry = self._disk.get(name)
+            if entry is not None:
+                entry[1] = now
+        try:
+            os.utime(disk_path, (now, now))
+        except OSError:
+            pass
+
+    def evict(self):
+        """磁碟快取超過上限時淘汰最久未使用的圖片，回傳釋放的位元組數"""
+        freed = 0
+        with self._lock:
+            if self._disk_bytes <= self.max_disk_bytes:
+                return 0
+            for name in sorted(self._disk, key=lambda n: self._disk[n][1]):
+                if self._disk_bytes <= self.max_disk_bytes:
+                    break
+                size = self._disk.pop(name)[0]
+                try:
+                    os.remove(os.path.join(self.root, name))
+                except FileNotFoundError:
+                    pass
+                self._disk_bytes -= size
+                freed += size
+        if freed:
+            print(f"[DEBUG] 圖片快取淘汰 {freed / 1e6:.1f} MB")
+        return freed
+
+    async def encode_many(self, paths, model):
+        """依模型輸入解析度編碼多張圖片；無法處理的圖片改送原始路徑"""
+        max_side = input_size(model)
+
+        def run():
+            payloads = []
+            for path in paths:
+                try:
+                    payloads.append(self.encode(path, max_side))
+                except Exception as e:
+                    print(f"[ERROR] 圖片前處理失敗 {path}: {e}")
+                    payloads.append(path)
+            return payloads
+
+        return await asyncio.to_thread(run)
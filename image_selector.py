@@ -0,0 +1,99 @@
+import os
+import re
+from collections import OrderedDict
+from context_budget import image_budget
+from document_index import embed_texts
+
+# 提問中泛指圖片的用語（沒有指定檔名時，視為指最新上傳的圖片）
+_IMAGE_REFERENCE_RE = re.compile(r'圖片|這張圖|那張圖|圖中|截圖|照片|image|picture|photo|screenshot', re.I)
+_IMAGE_LINK_RE = re.compile(r'!\[[^\]]*\]\([^)]+\)')
+
+
+def image_captions(md_text, image_paths, window=300):
+    """取每張 PDF 圖片在 Markdown 中前後的文字作為說明，回傳 {圖片路徑: 說明}"""
+    captions = {}
+    for path in image_paths:
+        position = md_text.find(path)
+        if position < 0:
+            captions[path] = ""
+            continue
+        nearby = md_text[max(position - window, 0):position + len(path) + window]
+        captions[path] = " ".join(_IMAGE_LINK_RE.sub(" ", nearby).split())
+    return captions
+
+
+class ImageSelector:
+    """
+    每回合挑選要附加給視覺模型的圖片（不超過模型的圖片預算），優先順序：
+    1. 提問中以檔名指定的圖片
+    2. 上一回合之後上傳的圖片（提問泛指「這張圖」等時，至少附上最新一張）
+    3. 說明文字（PDF 圖片周圍的內容）與提問語意相近的圖片
+    說明文字的向量以 LRU 快取最多 cache_size 筆（圖片被清理後的項目會自然被擠出）
+    """
+
+    def __init__(self, client, embed_model, min_score=0.35, cache_size=1024):
+        self.client = client
+        self.embed_model = embed_model
+        self.min_score = min_score
+        self.cache_size = cache_size
+        self._caption_vectors = OrderedDict()  # (path, caption) -> 正規化向量
+
+    async def _relevant(self, question, records):
+        """回傳說明與提問相關的圖片路徑，依相似度由高到低"""
+        records = [r for r in records if r[3]]
+        if not records or not question:
+            return []
+        vectors = {}
+        missing = []
+        for record in records:
+            key = (record[0], record[3])
+            if key in self._caption_vectors:
+                self._caption_vectors.move_to_end(key)
+                vectors[key] = self._caption_vectors[key]
+            else:
+                missing.append(record)
+        if missing:
+            embedded = await embed_texts(self.client, self.embed_model, [r[3] for r in missing])
+            for record, vector in zip(missing, embedded):
+                vectors[(record[0], record[3])] = vector
+                self._caption_vectors[(record[0], record[3])] = vector
+            while len(self._caption_vectors) > self.cache_size:
+                self._caption_vectors.popitem(last=False)
+        query_vector = (await embed_texts(self.client, self.embed_model, [question]))[0]
+        scored = [(float(vectors[(r[0], r[3])] @ query_vector), r[0]) for r in records]
+        return [path for score, path in sorted(scored, reverse=True) if score >= self.min_score]
+
+    async def select(self, question, records, since, model):
+        """
+        records：[(path, source, created_at, caption), ...]（最舊的在前）
+        since：上一回合的時間，之後上傳的圖片視為新圖片
+        回傳選中的圖片路徑（依上傳時間排序）
+        """
+        budget = image_budget(model)
+        if not records or budget <= 0:
+            return []
+        question = question or ""
+        lowered = question.lower()
+
+        referenced = [r[0] for r in records if os.path.basename(r[0]).lower() in lowered]
+        new_uploads = [r[0] for r in records if r[1] == "upload" and r[2] > since]
+        uploads = [r[0] for r in records if r[1] == "upload"]
+        if not new_uploads and uploads and _IMAGE_REFERENCE_RE.search(question):
+            new_uploads = uploads[-1:]
+
+        chosen = []
+        for path in referenced + list(reversed(new_uploads)):
+            if path not in chosen and len(chosen) < budget:
+                chosen.append(path)
+        if len(chosen) < budget:
+            remaining = [r for r in records if r[0] not in chosen]
+            try:
+                for path in await self._relevant(question, remaining):
+                    if len(chosen) >= budget:
+                        break
+                    chosen.append(path)
+            except Exception as e:
+                print(f"[WARNING] 圖片相關性比對失敗，只使用新上傳或指定的圖片: {e}")
+
+        order = {r[0]: i for i, r in enumerate(records)}
+        return sorted(chosen, key=order.get)
@@ -0,0 +1,112 @@
+import asyncio
+import os
+import time
+
+
+class Janitor:
+    """
+    背景清理頻道檔案（不在使用者請求的路徑上執行），每 interval 秒掃描一次：
+    - 已使用完的上傳文件（資料庫中已無對應內容）
+    - 超過 pdf_image_ttl 秒的 PDF 圖片
+    - 超過 max_idle_turns 次提問都沒有被放進 prompt 的上傳圖片、超過 max_images 張時最舊的圖片
+    - 頻道檔案總大小超過 max_channel_bytes 時，從最舊的圖片或文件開始刪除
+    檔案清單與大小取自各頻道的 ChannelManifest，不需掃描目錄
+    bytes_reclaimed / files_removed 為累計的清理量
+    """
+
+    def __init__(self, store, manifests, interval=300, max_images=10, max_idle_turns=10, pdf_image_ttl=3600,
+                 max_channel_bytes=500 * 1024 * 1024, document_grace=900):
+        self.store = store
+        self.manifests = manifests
+        self.interval = interval
+        self.max_images = max_images
+        self.max_idle_turns = max_idle_turns
+        self.pdf_image_ttl = pdf_image_ttl
+        self.max_channel_bytes = max_channel_bytes
+        # 剛下載、仍在轉換中的文件不清理
+        self.document_grace = document_grace
+        self.bytes_reclaimed = 0
+        self.files_removed = 0
+        self._task = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._loop())
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await asyncio.to_thread(self.sweep)
+            except Exception as e:
+                print(f"[ERROR] 背景清理時出錯: {e}")
+
+    def _remove(self, manifest, path):
+        size = manifest.remove(path)
+        self.bytes_reclaimed += size
+        self.files_removed += 1
+        return size
+
+    def _remove_image(self, channel_id, manifest, path, reason):
+        self._remove(manifest, path)
+        self.store.remove_image(channel_id, path)
+        print(f"[DEBUG] 已刪除{reason}的圖片: {path}")
+
+    def sweep(self):
+        """掃描所有頻道一次，回傳這次釋放的位元組數"""
+        before = self.bytes_reclaimed
+        for channel_id in self.store.list_channels():
+            try:
+                self.sweep_channel(channel_id)
+            except Exception as e:
+                print(f"[ERROR] 清理頻道 {channel_id} 時出錯: {e}")
+        reclaimed = self.bytes_reclaimed - before
+        if reclaimed:
+            print(f"[DEBUG] 背景清理釋放 {reclaimed / 1e6:.1f} MB（累計 {self.bytes_reclaimed / 1e6:.1f} MB，"
+                  f"{self.files_removed} 個檔案）")
+        return reclaimed
+
+    def sweep_channel(self, channel_id):
+        manifest = self.manifests.get(channel_id)
+        now = time.time()
+
+        # 1. 已使用完的上傳文件
+        pending = {os.path.abspath(path) for path, _ in self.store.list_documents(channel_id) if path}
+        for entry in manifest.documents():
+            if os.path.abspath(entry.path) not in pending and now - entry.mtime > self.document_grace:
+                self._remove(manifest, entry.path)
+                print(f"[DEBUG] 已刪除處理完的原始文件: {entry.path}")
+
+        # 2. 過期的 PDF 圖片
+        for path in self.store.list_images(channel_id, source="pdf", older_than=now - self.pdf_image_ttl):
+            self._remove_image(channel_id, manifest, path, f"超過 {self.pdf_image_ttl // 60} 分鐘")
+
+        # 3. 閒置與超量的上傳圖片
+        # 閒置以頻道的提問計數器判斷（不受摘要刪除舊回合影響）：超過 max_idle_turns 次提問都沒被放進 prompt
+        for path in self.store.list_idle_images(channel_id, self.max_idle_turns):
+            self._remove_image(channel_id, manifest, path, "閒置太久")
+        uploads = [r[0] for r in self.store.list_image_records(channel_id) if r[1] == "upload"]
+        while len(uploads) > self.max_images:
+            self._remove_image(channel_id, manifest, uploads.pop(0), "超過數量上限")
+
+        # 4. 頻道總大小（manifest 隨檔案增刪維護總量）：圖片與文件一起從最舊的開始刪除
+        if manifest.total_bytes > self.max_channel_bytes:
+            candidates = [(created_at, "image", path) for path, _, created_at, _ in self.store.list_image_records(channel_id)]
+            # 仍在寬限期內的文件可能正在轉換，不刪除；文件內容已存進資料庫，刪除原始檔不影響回答
+            candidates += [(entry.mtime, "document", entry.path) for entry in manifest.documents()
+                           if now - entry.mtime > self.document_grace]
+            for _, kind, path in sorted(candidates):
+                if manifest.total_bytes <= self.max_channel_bytes:
+                    break
+                if kind == "image":
+                    self._remove_image(channel_id, manifest, path, "超過頻道大小上限")
+                else:
+                    self._remove(manifest, path)
+                    print(f"[DEBUG] 已刪除超過頻道大小上限的文件: {path}")
+
+        pdf_image_dir = os.path.join(str(channel_id), "pdf_images")
+        if not manifest.files("pdf_image") and os.path.isdir(pdf_image_dir):
+            try:
+                os.rmdir(pdf_image_dir)
+            except OSError:
+                pass
@@ -0,0 +1,87 @@
+import asyncio
+import numpy as np
+from document_index import embed_texts
+from token_counter import count_tokens
+
+
+def format_exchange(user_turn, assistant_turn):
+    return f"Human: {user_turn.content}\nAI: {assistant_turn.content}"
+
+
+class MemoryIndex:
+    """
+    單一頻道的長期語意記憶：
+    - 每次問答（user + assistant）embed 成一筆記憶，以 user 回合的 row id 辨識，向量保存在資料庫，摘要折疊舊對話後仍可檢索
+    - 提問時以 cosine 相似度取出與問題最相關的過往問答，搭配最近幾回合一起放進 prompt
+    """
+
+    def __init__(self, client, embed_model, store, channel_id, top_k=4):
+        self.client = client
+        self.embed_model = embed_model
+        self.store = store
+        self.channel_id = channel_id
+        self.top_k = top_k
+        self._entries = []  # [(turn_id, content, tokens), ...]
+        self._turn_ids = set()
+        self._vectors = None
+        # 背景的 remember_exchange 與下一個請求的 recall_memories 可能同時索引同一段問答
+        self._lock = asyncio.Lock()
+        # 頻道被清除後設為 True，之後完成的 embed 不再寫入
+        self._discarded = False
+        for turn_id, content, tokens, blob in store.load_memories(channel_id):
+            self._append(turn_id, content, tokens, np.frombuffer(blob, dtype=np.float32))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def discard(self):
+        """頻道記憶被清除時呼叫"""
+        self._discarded = True
+
+    def _append(self, turn_id, content, tokens, vector):
+        vector = vector.reshape(1, -1)
+        if self._vectors is not None and self._vectors.shape[1] != vector.shape[1]:
+            # 換了 embedding 模型，舊向量無法比較，跳過
+            return
+        self._vectors = vector if self._vectors is None else np.vstack([self._vectors, vector])
+        self._entries.append((turn_id, content, tokens))
+        self._turn_ids.add(turn_id)
+
+    async def add_turns(self, turns):
+        """索引尚未記錄的問答（以 user 回合的 row id 辨識，尚未寫入資料庫的回合略過），增量更新"""
+        async with self._lock:
+            await self._add_pending(turns)
+
+    async def _add_pending(self, turns):
+        pending = [
+            (user_turn, assistant_turn)
+            for user_turn, assistant_turn in zip(turns, turns[1:])
+            if user_turn.role == "user" and assistant_turn.role == "assistant"
+            and user_turn.id is not None and user_turn.id not in self._turn_ids
+        ]
+        if not pending or self._discarded:
+            return
+        contents = [format_exchange(u, a) for u, a in pending]
+        vectors = await embed_texts(self.client, self.embed_model, contents)
+        if self._discarded:
+            return
+        for (user_turn, _), content, vector in zip(pending, contents, vectors):
+            tokens = count_tokens(content)
+            self.store.add_memory(self.channel_id, user_turn.id, content, tokens, vector.tobytes())
+            self._append(user_turn.id, content, tokens, vector)
+
+    async def search(self, query, before=None, top_k=None):
+        """
+        回傳與問題最相關的過往問答 [(content, tokens), ...]，依時間排序
+        before：只搜尋 row id 小於此值的記憶（排除已在最近視窗內的回合）
+        """
+        if not self._entries or not query:
+            return []
+        candidates = [i for i, (turn_id, _, _) in enumerate(self._entries) if before is None or turn_id < before]
+        if not candidates:
+            return []
+        k = min(top_k or self.top_k, len(candidates))
+        query_vector = (await embed_texts(self.client, self.embed_model, [query]))[0]
+        scores = self._vectors[candidates] @ query_vector
+        best = np.argpartition(-scores, k - 1)[:k]
+        return [self._entries[candidates[i]][1:] for i in sorted(best)]
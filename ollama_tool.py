@@ -5,9 +5,17 @@ from bs4 import BeautifulSoup  # 加入此匯入以使用 BeautifulSoup
 import time
 import requests
 import ollama
+import http_pool
+from html_extract import extract_text, sniff_encoding
+from page_summarizer import PageSummarizer
+from prefetcher import PrefetchCancelled
 # 儲存當前選擇的模型
 current_model = "mistral-small3.1"  # 預設模型
 client = ollama.Client(host="http://localhost:11434")
+# 網頁摘要階段；bot 可依 config.json 換成指定的小模型
+page_summarizer = PageSummarizer(client)
+# 搜尋結果預取（SearchPrefetcher）；預設關閉，由 bot 依 config.json 啟用
+prefetcher = None
 def generate_function_description(func):
     func_name = func.__name__
     docstring = func.__doc__
@@ -117,7 +125,7 @@ def get_current_weather(city:str) -> str:
         A string with the current temperature in Celsius for the city.
     """
     base_url = f"https://wttr.in/{city}?format=j1"
-    response = requests.get(base_url)
+    response = http_pool.get(base_url)
     data = response.json()
     return f"The current temperature in {city} is: {data['current_condition'][0]['temp_C']}°C"
 
@@ -134,7 +142,7 @@ def web_search(query: str) -> str:
     max_results = 3
     url = f"https://duckduckgo.com/html/?q={requests.utils.requote_uri(query)}"
     headers = {"User-Agent": "Mozilla/5.0"}
-    res = requests.get(url, headers=headers)
+    res = http_pool.get(url, headers=headers)
     soup = BeautifulSoup(res.text, 'html.parser')
     results = []
     for a in soup.find_all("a", class_="result__url", href=True)[:max_results]:
@@ -142,6 +150,47 @@ def web_search(query: str) -> str:
         href = a['href']
         results.append(f"{title}: {href}")
     return "\n".join(results) if results else "No results found."
+
+
+# fetch_url_content 下載與擷取的上限
+MAX_PAGE_BYTES = 2 * 1024 * 1024
+MAX_PAGE_CHARS = 60000  # 約為摘要階段 max_chunks * chunk_tokens
+HTML_CONTENT_TYPES = ("text/html", "application/xhtml+xml", "text/plain")
+# 摘要失敗時的原文節錄開頭（tool_cache 不快取以此開頭的結果）
+SUMMARY_FAILED_PREFIX = "網頁摘要失敗，以下為原文節錄"
+
+
+def fetch_html(url, max_bytes=MAX_PAGE_BYTES, cancel_event=None):
+    """
+    以串流方式下載網頁，最多讀取 max_bytes 位元組（超過的部分直接捨棄），回傳 (HTML, 位元組數)
+    非 HTML/純文字的內容（PDF、圖片、影片等）不下載，拋出 ValueError；cancel_event 被設定時拋出 PrefetchCancelled
+    """
+    with http_pool.get(url, headers={"User-Agent": "Mozilla/5.0"}, timeout=10, stream=True) as res:
+        res.raise_for_status()
+        content_type = res.headers.get("Content-Type", "").split(";")[0].strip().lower()
+        if content_type and content_type not in HTML_CONTENT_TYPES:
+            raise ValueError(f"不支援的內容類型 {content_type}")
+        chunks, size = [], 0
+        for chunk in res.iter_content(chunk_size=64 * 1024):
+            if cancel_event is not None and cancel_event.is_set():
+                raise PrefetchCancelled(f"已取消下載 {url}")
+            chunks.append(chunk)
+            size += len(chunk)
+            if size >= max_bytes:
+                print(f"[DEBUG] 網頁超過 {max_bytes} bytes，只讀取前段: {url}")
+                break
+        raw = b"".join(chunks)[:max_bytes]
+        # 標頭沒有 charset 時 requests 對 text/html 會回傳 ISO-8859-1，改以 <meta charset> 判斷
+        header_encoding = res.encoding if "charset" in res.headers.get("Content-Type", "").lower() else None
+    return raw.decode(sniff_encoding(raw, header_encoding), errors="replace"), len(raw)
+
+
+def load_page_text(url, max_bytes=MAX_PAGE_BYTES, cancel_event=None):
+    """下載網頁並擷取正文，回傳 (正文, 下載位元組數)；供預取使用"""
+    html, size = fetch_html(url, max_bytes, cancel_event)
+    return extract_text(html, max_chars=MAX_PAGE_CHARS), size
+
+
 def fetch_url_content(url: str, user_input: str) -> str:
     """
     Fetch a web page and return its text content.
@@ -154,53 +203,30 @@ def fetch_url_content(url: str, user_input: str) -> str:
         A string containing the web page's text content. 
     
     Note:
-        This function uses a custom User-Agent header and a timeout of 10 seconds.
+        This function uses a custom User-Agent header, a timeout of 10 seconds and the shared connection pool.
         Any exceptions during the request are caught and reported in the returned string.
     """
     try:
-        # Send an HTTP GET request to fetch the web page
-        res = requests.get(url, headers={"User-Agent": "Mozilla/5.0"}, timeout=10)
-        res.encoding = res.apparent_encoding  # 自動檢測編碼
-        
-        # 使用BeautifulSoup解析HTML
-        soup = BeautifulSoup(res.text, 'html.parser')
+        # 搜尋後已在背景預取的網頁直接使用
+        text = prefetcher.take(url) if prefetcher is not None else None
+        if text is None:
+            html, _ = fetch_html(url)
+            # 只擷取需要的正文長度，取到足夠文字就停止
+            text = extract_text(html, max_chars=MAX_PAGE_CHARS if user_input else 2000)
         
-        # 移除不必要的元素
-        for tag in soup(['script', 'style', 'meta', 'link', 'header', 'footer', 'nav']):
-            tag.decompose()
-            
-        # 提取主要文本內容
-        text = soup.get_text(separator="\n").strip()
-        
-        # 清理文本
-        text = re.sub(r'\n+', '\n', text)  # 移除多餘的換行
-        text = re.sub(r'\s+', ' ', text)   # 移除多餘的空格
-        
-        # 如果有用戶輸入，使用LLM生成相關摘要
-        if user_input:
-            # 準備消息
-            url_promt = [
-                {"role": "system", "content": f"""請根據關鍵詞「{user_input}」從以下網頁內容中提取相關資訊並生成摘要。
-                要求：
-                1. 摘要限制在1000字以內
-                2. 在不超過長度限制的前提下，保留與關鍵詞最相關的內容
-                3. 如果找不到相關內容，請正常提取網頁摘要即可。
-                """},
-                {"role": "user", "content": f"網頁內容:\n{text[:20000]}"}  # 限制輸入長度
-            ]
-            print(f"[debug] url promt: {url_promt}")
-            # 調用LLM生成摘要
-            
-            response = client.chat(
-                model=current_model,
-                messages=url_promt
-            )
-            print(f"\n========\n[debug] response: {response['message']}")
-            # 獲取摘要
-            if response and 'message' in response and 'content' in response['message']:
-                return f"來源: {url}\n\n" + response['message']['content']
+        # 如果有用戶輸入，使用LLM生成相關摘要（長網頁分段同時摘要後再合併）
+        if user_input and text:
+            try:
+                summary = page_summarizer.summarize(url, text, user_input, default_model=current_model)
+            except Exception as e:
+                print(f"[ERROR] 網頁摘要失敗，改回傳原文: {e}")
+                summary = None
+            if summary:
+                return f"來源: {url}\n\n" + summary
+            # 摘要失敗時改回傳原文節錄；以失敗前綴開頭，不會被當成摘要快取
+            return f"{SUMMARY_FAILED_PREFIX}（來源: {url}）\n\n" + text[:2000] + "..."
             
-        # 如果沒有用戶輸入或LLM處理失敗，返回原始文本的前1000個字符
+        # 沒有用戶輸入時，返回原始文本的前2000個字符
         return f"來源: {url}\n\n" + text[:2000] + "..."
         
     except Exception as e:
@@ -257,8 +283,13 @@ def google_search(query: str) -> str:
         url = f"https://www.googleapis.com/customsearch/v1?key={api_key}&cx={cx}&q={requests.utils.requote_uri(query)}&num={max_results}"
         
         # 發送 API 請求
-        res = requests.get(url)
+        res = http_pool.get(url)
         data = res.json()
+        # 配額用盡、金鑰錯誤或重試後仍失敗時，API 回傳 error 而沒有 items；不可當成「沒有結果」（會被快取）
+        if res.status_code != 200 or "error" in data:
+            error = data.get("error", "")
+            message = error.get("message", "") if isinstance(error, dict) else error
+            return f"Error occurred while searching: HTTP {res.status_code} {message}".strip()
         results = []
         
         # 處理搜尋結果
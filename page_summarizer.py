@@ -0,0 +1,116 @@
+import contextvars
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from context_budget import truncate_to_tokens
+from document_index import split_into_chunks
+
+MAP_PROMPT = """請根據關鍵詞「{query}」從以下網頁片段中提取相關資訊並生成摘要。
+    要求：
+    1. 摘要限制在300字以內
+    2. 只保留與關鍵詞相關的事實、數字與結論
+    3. 如果片段中沒有相關內容，只輸出「無相關內容」
+    """
+
+REDUCE_PROMPT = """以下是同一個網頁各段落的摘要，請根據關鍵詞「{query}」整合成一份摘要。
+    要求：
+    1. 摘要限制在1000字以內
+    2. 在不超過長度限制的前提下，保留與關鍵詞最相關的內容，刪除重複的部分
+    3. 如果找不到相關內容，請正常提取網頁摘要即可。
+    """
+
+NO_MATCH = "無相關內容"
+
+# 呼叫工具的對話請求使用的 (model, num_ctx)，由 bot 在執行工具前設定（ToolRunner 會把 context 帶進執行緒）
+chat_model_context = contextvars.ContextVar("chat_model_context", default=None)
+
+
+class PageSummarizer:
+    """
+    fetch_url_content 的網頁摘要階段（map-reduce）：
+    - 網頁正文依段落切成 chunk_tokens 以內的片段，最多 max_chunks 段
+    - 各片段以較小的 model 同時摘要（map），再合併成一份摘要（reduce）；只有一段時直接摘要
+    - 結果依（網址, 正文雜湊, 關鍵詞）快取，網頁內容沒變就不重新摘要
+    - 所有網頁共用 max_concurrent 個生成名額：工具在回答回合內執行，已佔用該頻道的排程器名額，
+      不能再向 RequestScheduler 排隊（會等到自己），因此在這裡另外限制同時送往 Ollama 的摘要請求
+    model 為 None 時使用呼叫工具的對話模型（通常是大模型，建議在 config.json 指定 PAGE_SUMMARY_MODEL），
+    並沿用該對話請求的 num_ctx：同一個模型換用不同的 num_ctx 會讓 Ollama 重新載入模型；
+    此時片段大小會縮小到放得進該 num_ctx
+    """
+
+    def __init__(self, client, model=None, chunk_tokens=3000, max_chunks=8, max_workers=4,
+                 num_ctx=8192, cache_size=256, max_concurrent=2, answer_reserve=1536):
+        self.client = client
+        self.model = model
+        self.chunk_tokens = chunk_tokens
+        self.max_chunks = max_chunks
+        self.num_ctx = num_ctx
+        # 每次摘要請求為提示詞與回答預留的 token 數
+        self.answer_reserve = answer_reserve
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation_slots = threading.BoundedSemaphore(max_concurrent)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="page-summary")
+
+    @staticmethod
+    def cache_key(url, text, query):
+        digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        return url.strip(), digest, " ".join(query.split()).lower()
+
+    def _chat(self, model, num_ctx, system, content):
+        with self._generation_slots:
+            response = self.client.chat(
+                model=model,
+                messages=[{"role": "system", "content": system}, {"role": "user", "content": content}],
+                options={"num_ctx": num_ctx})
+        return response['message']['content'].strip()
+
+    def _map(self, model, num_ctx, query, chunk):
+        try:
+            return self._chat(model, num_ctx, MAP_PROMPT.format(query=query), f"網頁片段:\n{chunk}")
+        except Exception as e:
+            print(f"[ERROR] 網頁片段摘要失敗: {e}")
+            return None
+
+    def summarize(self, url, text, query, default_model=None):
+        """回傳網頁摘要；模型呼叫全部失敗時拋出例外"""
+        key = self.cache_key(url, text, query)
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+                print(f"[DEBUG] 網頁摘要快取命中: {url}")
+                return cached
+
+        chat = chat_model_context.get()
+        if self.model:
+            model, num_ctx = self.model, self.num_ctx
+        elif chat is not None:
+            model, num_ctx = chat
+        else:
+            model, num_ctx = default_model, self.num_ctx
+        chunk_tokens = max(min(self.chunk_tokens, num_ctx - self.answer_reserve), 256)
+        chunks = split_into_chunks(text, chunk_tokens)[:self.max_chunks]
+        if len(chunks) <= 1:
+            summary = self._chat(model, num_ctx, REDUCE_PROMPT.format(query=query), f"網頁內容:\n{text}")
+        else:
+            partials = list(self._executor.map(lambda chunk: self._map(model, num_ctx, query, chunk), chunks))
+            partials = [p for p in partials if p and p != NO_MATCH]
+            if not partials:
+                # 每段都沒有相關內容（或失敗）時，以第一段產生一般摘要
+                partials = [chunks[0]]
+            print(f"[DEBUG] 網頁 {url} 分為 {len(chunks)} 段摘要，{len(partials)} 段有內容")
+            merged = "\n\n".join(f"段落 {i + 1}:\n{p}" for i, p in enumerate(partials))
+            summary = self._chat(model, num_ctx, REDUCE_PROMPT.format(query=query),
+                                 truncate_to_tokens(merged, chunk_tokens))
+
+        with self._lock:
+            self._cache[key] = summary
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return summary
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,154 @@
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# google_search 結果每行為「標題,網址」
+_URL_RE = re.compile(r'https?://[^\s,]+')
+
+
+class PrefetchCancelled(Exception):
+    """預取已取消（回合結束）或超出位元組預算"""
+
+
+def result_urls(search_result, limit):
+    """依順序取出搜尋結果中不重複的網址"""
+    urls = []
+    for url in _URL_RE.findall(search_result or ""):
+        if url not in urls:
+            urls.append(url)
+        if len(urls) >= limit:
+            break
+    return urls
+
+
+class PrefetchTurn:
+    """
+    一個回答回合內的預取：
+    - 同一回合的多次搜尋共用 budget_bytes 位元組的下載預算
+    - cancel() 後尚未開始的預取不再執行，下載中的在下一個區塊停止
+    """
+
+    def __init__(self, prefetcher, budget_bytes):
+        self.prefetcher = prefetcher
+        self.remaining = budget_bytes
+        self.cancelled = threading.Event()
+        self.futures = []  # [(網址, future)]
+        self._lock = threading.Lock()
+
+    def reserve(self, max_bytes):
+        with self._lock:
+            allowance = min(max_bytes, self.remaining)
+            self.remaining -= allowance
+            return allowance
+
+    def refund(self, size):
+        with self._lock:
+            self.remaining += size
+
+    def start(self, search_result):
+        """google_search 回傳後呼叫，在背景預取前幾個結果"""
+        if not self.cancelled.is_set():
+            self.prefetcher.prefetch(self, result_urls(search_result, self.prefetcher.top_n))
+
+    def cancel(self):
+        self.cancelled.set()
+        for url, future in self.futures:
+            future.cancel()
+            if not future.done() or future.cancelled():
+                self.prefetcher.discard(url, future)
+
+
+class SearchPrefetcher:
+    """
+    搜尋結果的投機預取：模型幾乎都會接著對前幾個結果呼叫 fetch_url_content，
+    所以搜尋結果一回來就在背景下載並擷取前 top_n 個網頁的正文，之後的 fetch_url_content 直接取用
+    - load(url, max_bytes, cancel_event) -> (正文, 下載位元組數) 負責實際的下載與擷取
+    - 每頁最多 page_bytes，每個回合最多 turn_budget_bytes；剩餘預算少於 min_page_bytes 時不再預取
+    - 預取結果保留 ttl 秒，所有頻道共用
+    """
+
+    def __init__(self, load, top_n=3, turn_budget_bytes=6 * 1024 * 1024, page_bytes=2 * 1024 * 1024,
+                 min_page_bytes=64 * 1024, ttl=600, max_entries=64, max_workers=3):
+        self.load = load
+        self.top_n = top_n
+        self.turn_budget_bytes = turn_budget_bytes
+        self.page_bytes = page_bytes
+        self.min_page_bytes = min_page_bytes
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = {}  # 網址 -> (到期時間, future)
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prefetch")
+        self.hits = 0
+        self.misses = 0
+
+    def begin_turn(self):
+        return PrefetchTurn(self, self.turn_budget_bytes)
+
+    def prefetch(self, turn, urls):
+        now = time.monotonic()
+        with self._lock:
+            for url in urls:
+                entry = self._entries.get(url)
+                if entry is not None and entry[0] > now:
+                    continue
+                future = self._executor.submit(self._load, turn, url)
+                self._entries[url] = (now + self.ttl, future)
+                turn.futures.append((url, future))
+            self._evict(now)
+        print(f"[DEBUG] 預取搜尋結果: {urls}")
+
+    def _evict(self, now):
+        for url in [url for url, (expires_at, _) in self._entries.items() if expires_at <= now]:
+            del self._entries[url]
+        # 超過上限時先移除最早到期的已完成項目
+        done = sorted((expires_at, url) for url, (expires_at, future) in self._entries.items() if future.done())
+        for _, url in done[:max(len(self._entries) - self.max_entries, 0)]:
+            del self._entries[url]
+
+    def _load(self, turn, url):
+        if turn.cancelled.is_set():
+            raise PrefetchCancelled("回合已結束")
+        allowance = turn.reserve(self.page_bytes)
+        if allowance < self.min_page_bytes:
+            turn.refund(allowance)
+            raise PrefetchCancelled("超出本回合的預取預算")
+        try:
+            text, size = self.load(url, allowance, turn.cancelled)
+        except Exception:
+            turn.refund(allowance)
+            raise
+        turn.refund(allowance - size)
+        return text
+
+    def discard(self, url, future):
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None and entry[1] is future:
+                del self._entries[url]
+
+    def take(self, url, timeout=15):
+        """
+        fetch_url_content 呼叫：回傳預取的正文（仍在下載時等待完成）
+        沒有預取、已取消或失敗時回傳 None，由呼叫端自行下載
+        """
+        url = url.strip()
+        with self._lock:
+            entry = self._entries.get(url)
+        if entry is None or entry[0] <= time.monotonic():
+            self.misses += 1
+            return None
+        try:
+            text = entry[1].result(timeout)
+        except Exception as e:
+            print(f"[DEBUG] 預取未命中 {url}: {e!r}")
+            self.discard(url, entry[1])
+            self.misses += 1
+            return None
+        self.hits += 1
+        print(f"[DEBUG] 預取命中: {url}")
+        return text
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
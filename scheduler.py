@@ -0,0 +1,167 @@
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+
+
+class QueueFullError(Exception):
+    """頻道排隊中的請求已達上限"""
+
+
+class _Ticket:
+    def __init__(self, channel_id, background=False):
+        self.channel_id = channel_id
+        self.background = background
+        self.admitted = False
+        # 每次排隊狀況改變（有人被放行或取消）時觸發，讓等待者更新順位
+        self.changed = asyncio.Event()
+
+
+class RequestScheduler:
+    """
+    Ollama 請求的准入控制：
+    - 每個頻道一條有上限的佇列
+    - 頻道之間輪流（round-robin）放行，同一頻道同時只跑一個生成；
+      頻道被放行後移到輪替順序的最後，生成期間才加入的頻道也排在它前面
+    - 全域同時生成數量上限
+    - 背景工作（摘要等）走另一條低優先順序的佇列，只在沒有任何使用者請求等待時放行
+    """
+
+    def __init__(self, max_concurrent=2, max_queue_per_channel=5):
+        self.max_concurrent = max_concurrent
+        self.max_queue_per_channel = max_queue_per_channel
+        self._queues = {}          # channel_id -> deque[_Ticket]
+        self._round_robin = deque()  # 有排隊請求或正在生成的頻道輪替順序
+        self._running = set()      # 正在生成的 channel_id
+        self._background = deque()  # 背景工作的 _Ticket（不計入頻道佇列上限）
+
+    def submit(self, channel_id, background=False):
+        """加入頻道佇列，佇列已滿時拋出 QueueFullError；background 的請求加入低優先順序佇列"""
+        if background:
+            ticket = _Ticket(channel_id, background=True)
+            self._background.append(ticket)
+            self._dispatch()
+            return ticket
+        queue = self._queues.setdefault(channel_id, deque())
+        if len(queue) >= self.max_queue_per_channel:
+            raise QueueFullError(f"頻道 {channel_id} 排隊中的請求已達上限 {self.max_queue_per_channel}")
+        ticket = _Ticket(channel_id)
+        queue.append(ticket)
+        if channel_id not in self._round_robin:
+            # 排在正在生成的頻道之前：剛被放行過的頻道要等其他頻道輪過一次
+            index = next((i for i, ch in enumerate(self._round_robin) if ch in self._running),
+                         len(self._round_robin))
+            self._round_robin.insert(index, channel_id)
+        self._dispatch()
+        return ticket
+
+    def position(self, ticket):
+        """回傳前面還有幾個請求會先被放行（0 表示下一個）"""
+        if ticket.admitted:
+            return 0
+        if ticket.background:
+            waiting = sum(len(q) for q in self._queues.values())
+            return waiting + list(self._background).index(ticket)
+        # 依 round-robin 順序模擬放行，計算排在它前面的請求數
+        queues = {ch: list(q) for ch, q in self._queues.items()}
+        order = list(self._round_robin)
+        ahead = 0
+        while order:
+            next_order = []
+            for ch in order:
+                pending = queues.get(ch)
+                if not pending:
+                    continue
+                head = pending.pop(0)
+                if head is ticket:
+                    return ahead
+                ahead += 1
+                if pending:
+                    next_order.append(ch)
+            order = next_order
+        return ahead
+
+    def release(self, ticket):
+        """生成結束（或放棄排隊）時呼叫"""
+        channel_id = ticket.channel_id
+        if ticket.admitted:
+            self._running.discard(channel_id)
+        elif ticket.background:
+            if ticket in self._background:
+                self._background.remove(ticket)
+        else:
+            queue = self._queues.get(channel_id)
+            if queue and ticket in queue:
+                queue.remove(ticket)
+        # 沒有排隊也沒有在生成的頻道離開輪替順序
+        if not ticket.background and not self._queues.get(channel_id) and channel_id not in self._running:
+            self._queues.pop(channel_id, None)
+            if channel_id in self._round_robin:
+                self._round_robin.remove(channel_id)
+        self._dispatch()
+
+    def _dispatch(self):
+        # 依序放行可執行的頻道，直到達到全域上限
+        skipped = 0
+        while len(self._running) < self.max_concurrent and skipped < len(self._round_robin):
+            channel_id = self._round_robin.popleft()
+            queue = self._queues.get(channel_id)
+            if not queue:
+                self._queues.pop(channel_id, None)
+                if channel_id in self._running:
+                    # 正在生成的頻道留在最後，生成結束時才移除
+                    self._round_robin.append(channel_id)
+                    skipped += 1
+                continue
+            if channel_id in self._running:
+                # 這個頻道還在生成，先讓給其他頻道
+                self._round_robin.append(channel_id)
+                skipped += 1
+                continue
+            ticket = queue.popleft()
+            ticket.admitted = True
+            ticket.changed.set()
+            self._running.add(channel_id)
+            # 剛放行的頻道移到最後
+            self._round_robin.append(channel_id)
+            if not queue:
+                self._queues.pop(channel_id, None)
+            skipped = 0
+        # 使用者請求都已放行（沒有人在等待）時，才放行背景工作
+        if not any(self._queues.values()):
+            for ticket in list(self._background):
+                if len(self._running) >= self.max_concurrent:
+                    break
+                if ticket.channel_id in self._running:
+                    continue
+                self._background.remove(ticket)
+                ticket.admitted = True
+                ticket.changed.set()
+                self._running.add(ticket.channel_id)
+        # 通知所有等待者順位已更新
+        for queue in self._queues.values():
+            for waiting in queue:
+                waiting.changed.set()
+        for waiting in self._background:
+            waiting.changed.set()
+
+    @asynccontextmanager
+    async def slot(self, channel_id, on_position=None, background=False):
+        """
+        取得一個生成名額，等待期間順位改變時呼叫 on_position(順位)
+        用法：async with scheduler.slot(channel_id, callback): ...
+        background=True 時為低優先順序的背景工作
+        """
+        ticket = self.submit(channel_id, background)
+        try:
+            last_position = None
+            while not ticket.admitted:
+                position = self.position(ticket) + 1
+                if on_position and position != last_position:
+                    await on_position(position)
+                    last_position = position
+                ticket.changed.clear()
+                if not ticket.admitted:
+                    await ticket.changed.wait()
+            yield ticket
+        finally:
+            self.release(ticket)
@@ -0,0 +1,143 @@
+import asyncio
+from context_budget import choose_num_ctx, truncate_to_tokens
+from token_counter import count_tokens
+
+SUMMARY_PROMPT = """請將以下新的對話內容整合進既有的對話摘要：
+    1. 保留關鍵的上下文信息（人名、數字、結論、使用者的偏好與要求）
+    2. 保持對話的連貫性
+    3. 刪除重複或不重要的內容
+    4. 只輸出更新後的摘要本身
+
+    既有摘要：
+    {summary}
+
+    新的對話：
+    {turns}
+
+    更新後的摘要："""
+
+
+def format_turns(turns):
+    labels = {"user": "Human", "assistant": "AI", "system": "Summary"}
+    return "\n".join(f"{labels.get(t.role, t.role)}: {t.content}" for t in turns)
+
+
+class RollingSummarizer:
+    """
+    背景滾動摘要：
+    - 每次對話結束後排程，頻道閒置 idle_delay 秒後才執行
+    - 只把「尚未摘要且不在最近視窗內」的回合折疊進既有摘要
+    - 透過排程器的背景通道取得生成名額，只在沒有使用者請求等待時執行，不會和使用者請求搶 GPU
+    即時請求只讀取最新摘要與最近的回合，不會等待摘要完成
+    """
+
+    def __init__(self, client, scheduler, keep_recent_turns=8, trigger_ratio=0.5, idle_delay=30,
+                 summary_model=None, answer_reserve=1024, model_max_tokens=None, default_window=8192):
+        self.client = client
+        self.scheduler = scheduler
+        self.keep_recent_turns = keep_recent_turns
+        self.trigger_ratio = trigger_ratio
+        self.idle_delay = idle_delay
+        self.summary_model = summary_model
+        self.answer_reserve = answer_reserve
+        self.model_max_tokens = model_max_tokens or {}
+        self.default_window = default_window
+        self._tasks = {}
+
+    def needs_summary(self, session):
+        history = session.history
+        turns = history.turns
+        foldable = len(turns) - self.keep_recent_turns
+        # 邊界不可落在問答中間（回答留在最近視窗、問題卻被摘要掉）
+        while 0 < foldable < len(turns) and turns[foldable].role == "assistant":
+            foldable -= 1
+        if foldable <= 0:
+            return False
+        return history.total_tokens + history.summary_tokens > session.max_tokens * self.trigger_ratio
+
+    def schedule(self, session):
+        """對話結束後呼叫；新的對話會重設閒置計時"""
+        task = self._tasks.pop(session.channel_id, None)
+        if task is not None:
+            task.cancel()
+        if self.needs_summary(session):
+            self._tasks[session.channel_id] = asyncio.create_task(self._run_when_idle(session))
+
+    async def _run_when_idle(self, session):
+        try:
+            await asyncio.sleep(self.idle_delay)
+            # 每一批各自以低優先順序取得生成名額：有使用者請求在排隊時先讓使用者請求執行
+            while True:
+                async with self.scheduler.slot(session.channel_id, background=True):
+                    if not await self._fold_batch(session):
+                        break
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print(f"[ERROR] 頻道 {session.channel_id} 背景摘要失敗: {e}")
+        finally:
+            if self._tasks.get(session.channel_id) is asyncio.current_task():
+                del self._tasks[session.channel_id]
+
+    def context_window(self, session):
+        """摘要模型的 context 上限：指定 summary_model 時使用該模型自己的上限"""
+        if self.summary_model:
+            return self.model_max_tokens.get(self.summary_model, self.default_window)
+        return session.max_tokens
+
+    async def summarize(self, session):
+        """把可折疊的回合分批折疊進摘要；每一批連同既有摘要與回答保留量都放得進摘要模型的 context"""
+        while await self._fold_batch(session):
+            pass
+
+    async def _fold_batch(self, session):
+        """折疊一批最舊的回合，成功時回傳 True"""
+        history = session.history
+        turns = history.turns
+        foldable = len(turns) - self.keep_recent_turns
+        # 邊界不可落在問答中間（回答留在最近視窗、問題卻被摘要掉）
+        while 0 < foldable < len(turns) and turns[foldable].role == "assistant":
+            foldable -= 1
+        if foldable <= 0:
+            return False
+        window = self.context_window(session)
+        base_tokens = count_tokens(SUMMARY_PROMPT.format(summary=history.summary or "（無）", turns=""))
+        # 既有摘要很長時仍保留至少 1/4 的 context 給新的對話
+        budget = max(window - self.answer_reserve - base_tokens, window // 4)
+
+        # 以完整的問答為單位（user 回合與其後的回答）累加到預算為止
+        exchanges = []
+        for turn in turns[:foldable]:
+            if not exchanges or turn.role == "user":
+                exchanges.append([])
+            exchanges[-1].append(turn)
+        new_turns, turns_tokens = [], 0
+        for exchange in exchanges:
+            exchange_tokens = sum(turn.tokens + 4 for turn in exchange)  # 角色標籤與換行
+            if new_turns and turns_tokens + exchange_tokens > budget:
+                break
+            new_turns.extend(exchange)
+            turns_tokens += exchange_tokens
+        count = len(new_turns)
+        # 單一問答就超過預算時截斷，避免 Ollama 靜默截掉 prompt 開頭
+        turns_text = truncate_to_tokens(format_turns(new_turns), budget)
+        prompt = SUMMARY_PROMPT.format(summary=history.summary or "（無）", turns=turns_text)
+        model = self.summary_model or session.model
+        prompt_tokens = count_tokens(prompt)
+        print(f"[DEBUG] 頻道 {session.channel_id} 背景摘要 {count}/{foldable} 則對話（約 {prompt_tokens} tokens）")
+
+        response = await self.client.generate(
+            model=model,
+            prompt=prompt,
+            options={"num_ctx": choose_num_ctx(prompt_tokens, self.answer_reserve, window)})
+        summary = (response.get("response") or "").strip()
+        if not summary:
+            print("[ERROR] 摘要模型未返回內容")
+            return False
+
+        # 摘要期間歷史可能被清除，只在同一份歷史上折疊
+        if session.history is not history or history.turns[:count] != new_turns:
+            print(f"[DEBUG] 頻道 {session.channel_id} 歷史已變更，放棄這次摘要")
+            return False
+        session.fold_into_summary(count, summary)
+        return True
@@ -0,0 +1,123 @@
+import hashlib
+import math
+import re
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+# 中日韓文字：一般 tokenizer 約 1 字 1 token（寧可高估，避免 prompt 超出上限）
+_CJK_RE = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af]')
+_WORD_RE = re.compile(r'[A-Za-z]+')
+_NUMBER_RE = re.compile(r'\d+')
+# 其餘非空白、非英數、非中日韓的字元（標點、符號、emoji），各算 1 個 token
+_SYMBOL_RE = re.compile(r'[^\sA-Za-z\d\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af]')
+
+
+def estimate_tokens(text):
+    """不依賴 tokenizer 的估算：CJK 逐字計算，英文約 4 字元 1 token，數字約 3 位 1 token"""
+    if not text:
+        return 0
+    cjk = len(_CJK_RE.findall(text))
+    words = sum(max(1, math.ceil(len(w) / 4)) for w in _WORD_RE.findall(text))
+    numbers = sum(math.ceil(len(n) / 3) for n in _NUMBER_RE.findall(text))
+    symbols = len(_SYMBOL_RE.findall(text))
+    return cjk + words + numbers + symbols
+
+
+class TokenCounter:
+    """
+    token 計數服務：
+    - 優先使用本機已有的 tokenizer（transformers，僅讀本機快取，不連網）
+    - 其次使用 tiktoken（第一次使用時需下載編碼檔，tiktoken_timeout 秒內載入不完就放棄，離線啟動不會卡住）
+    - 都沒有時使用 CJK 感知的估算
+    相同文字的結果會被快取（系統提示、重複上傳的文件等）：
+    短文字以文字本身為 key；長文字（整份文件、工具結果）只以雜湊為 key，不讓快取保留全文
+    """
+
+    def __init__(self, tokenizer_name=None, cache_size=4096, long_text_chars=4096, long_cache_size=256,
+                 tiktoken_timeout=5):
+        self.backend = "estimate"
+        self._encode = None
+        if tokenizer_name:
+            self._load_transformers(tokenizer_name)
+        if self._encode is None:
+            self._load_tiktoken(tiktoken_timeout)
+        self._count_cached = lru_cache(maxsize=cache_size)(self._count)
+        self.long_text_chars = long_text_chars
+        self.long_cache_size = long_cache_size
+        self._long_cache = OrderedDict()  # 文字雜湊 -> token 數
+        self._long_lock = threading.Lock()
+        print(f"[DEBUG] token 計數使用: {self.backend}")
+
+    def _load_transformers(self, tokenizer_name):
+        try:
+            from transformers import AutoTokenizer
+            tokenizer = AutoTokenizer.from_pretrained(tokenizer_name, local_files_only=True)
+            self._encode = lambda text: tokenizer.encode(text, add_special_tokens=False)
+            self.backend = f"transformers:{tokenizer_name}"
+        except Exception as e:
+            print(f"[WARNING] 無法載入 tokenizer {tokenizer_name}，改用其他方式計數: {e}")
+
+    def _load_tiktoken(self, timeout):
+        # 編碼檔不在本機快取時 get_encoding 會連網下載，在背景執行緒中載入並限制等待時間
+        result = {}
+
+        def load():
+            try:
+                import tiktoken
+                result["encoding"] = tiktoken.get_encoding("cl100k_base")
+            except Exception:
+                pass
+
+        thread = threading.Thread(target=load, name="tiktoken-load", daemon=True)
+        thread.start()
+        thread.join(timeout)
+        encoding = result.get("encoding")
+        if encoding is None:
+            if thread.is_alive():
+                print(f"[WARNING] tiktoken 編碼檔 {timeout} 秒內未載入完成（可能無法連網），改用估算")
+            return
+        self._encode = encoding.encode
+        self.backend = "tiktoken:cl100k_base"
+
+    def _count(self, text):
+        if self._encode is not None:
+            try:
+                return len(self._encode(text))
+            except Exception:
+                pass
+        return estimate_tokens(text)
+
+    def count(self, text):
+        if not text:
+            return 0
+        if len(text) < self.long_text_chars:
+            return self._count_cached(text)
+        digest = hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+        with self._long_lock:
+            tokens = self._long_cache.get(digest)
+            if tokens is not None:
+                self._long_cache.move_to_end(digest)
+                return tokens
+        tokens = self._count(text)
+        with self._long_lock:
+            self._long_cache[digest] = tokens
+            while len(self._long_cache) > self.long_cache_size:
+                self._long_cache.popitem(last=False)
+        return tokens
+
+
+_counter = None
+
+
+def configure(tokenizer_name=None):
+    """設定全域使用的 tokenizer（未呼叫時第一次計數會自動以預設值初始化）"""
+    global _counter
+    _counter = TokenCounter(tokenizer_name)
+    return _counter
+
+
+def count_tokens(text):
+    if _counter is None:
+        configure()
+    return _counter.count(text)
@@ -0,0 +1,121 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlsplit, urlunsplit
+
+# 各工具結果的有效時間（秒），未列出的工具不快取（時間、計算等）
+TOOL_TTL = {
+    "google_search": 900,
+    "fetch_url_content": 1800,
+    "get_current_weather": 600,
+}
+# 工具以回傳字串表示失敗，這些結果不快取
+FAILURE_PREFIXES = (
+    "無法獲取或處理網頁內容",
+    "網頁摘要失敗",
+    "Error occurred",
+    "Google API key",
+    "Config file not found",
+    "Invalid config.json",
+)
+
+
+def _normalize_url(url):
+    parts = urlsplit(url.strip())
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path or "/", parts.query, ""))
+
+
+def cache_key(name, arguments):
+    """以工具名稱與正規化後的參數組成快取 key"""
+    normalized = {}
+    for key, value in arguments.items():
+        if isinstance(value, str):
+            value = " ".join(value.split())
+            if key == "url":
+                value = _normalize_url(value)
+            elif key in ("query", "city"):
+                value = value.lower()
+        normalized[key] = value
+    return json.dumps([name, normalized], ensure_ascii=False, sort_keys=True)
+
+
+class ToolResultCache:
+    """
+    網路工具結果的快取（所有頻道共用）：
+    - 每個工具各自的 TTL
+    - 記憶體中為依位元組數限制的 LRU
+    - 可選的磁碟層（SQLite），重新啟動後仍可命中
+    """
+
+    def __init__(self, ttl=None, max_bytes=16 * 1024 * 1024, disk_path=None):
+        self.ttl = TOOL_TTL if ttl is None else ttl
+        self.max_bytes = max_bytes
+        self._memory = OrderedDict()  # key -> (到期時間, 結果)
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._conn = None
+        if disk_path:
+            self._conn = sqlite3.connect(disk_path, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS tool_results (key TEXT PRIMARY KEY, expires_at REAL NOT NULL, value TEXT NOT NULL)")
+            self._conn.execute("DELETE FROM tool_results WHERE expires_at < ?", (time.time(),))
+
+    def ttl_for(self, name):
+        return self.ttl.get(name, 0)
+
+    def _remember(self, key, expires_at, value):
+        size = len(value.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_bytes -= len(old[1].encode("utf-8"))
+        self._memory[key] = (expires_at, value)
+        self._memory_bytes += size
+        while self._memory_bytes > self.max_bytes:
+            _, (_, evicted) = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted.encode("utf-8"))
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._memory[key]
+                self._memory_bytes -= len(entry[1].encode("utf-8"))
+            if self._conn is not None:
+                row = self._conn.execute(
+                    "SELECT expires_at, value FROM tool_results WHERE key = ? AND expires_at > ?", (key, now)).fetchone()
+                if row is not None:
+                    self._remember(key, row[0], row[1])
+                    self.hits += 1
+                    return row[1]
+            self.misses += 1
+            return None
+
+    def put(self, name, key, value):
+        ttl = self.ttl_for(name)
+        if ttl <= 0 or not isinstance(value, str) or value.startswith(FAILURE_PREFIXES):
+            return
+        expires_at = time.time() + ttl
+        with self._lock:
+            self._remember(key, expires_at, value)
+            if self._conn is not None:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO tool_results (key, expires_at, value) VALUES (?, ?, ?)",
+                    (key, expires_at, value))
+
+    def close(self):
+        if self._conn is not None:
+            with self._lock:
+                self._conn.close()
+                self._conn = None
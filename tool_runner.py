@@ -0,0 +1,114 @@
+import asyncio
+import contextvars
+import json
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from tool_cache import cache_key
+
+
+class ToolTimeoutError(Exception):
+    """工具執行超過時間限制"""
+
+
+def parse_arguments(arguments):
+    """模型回傳的參數可能是 JSON 字串或 dict"""
+    if isinstance(arguments, str):
+        try:
+            return json.loads(arguments)
+        except json.JSONDecodeError:
+            print(f"[ERROR] 無法解析工具參數: {arguments}")
+            return {}
+    return arguments or {}
+
+
+class ToolRunner:
+    """
+    同時執行模型在同一回合發出的多個工具調用：
+    - 工具本身是同步函式（requests 等），在專用的執行緒池中執行，不阻塞 event loop
+    - 每個工具各自有同時執行上限（例如避免同時對同一服務發出太多請求）
+    - 每次調用有時間上限（可依工具在 timeouts 中個別設定）；逾時的執行緒無法中止，會在結束後才釋放該工具的名額，
+      結果仍會寫入快取，模型重新調用時可直接取用
+    - 結果依調用順序回傳
+    - 有 cache（ToolResultCache）時，相同參數的調用直接取用快取；同時進行中的相同調用只執行一次
+    """
+
+    def __init__(self, functions, timeout=30, default_limit=4, limits=None, max_workers=8, cache=None, timeouts=None):
+        self.functions = functions
+        self.cache = cache
+        self._inflight = {}  # 快取 key -> 執行中的 future
+        self.timeout = timeout
+        self.timeouts = timeouts or {}
+        self.default_limit = default_limit
+        self.limits = limits or {}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tool")
+        self._semaphores = {}
+
+    def _semaphore(self, name):
+        semaphore = self._semaphores.get(name)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.limits.get(name, self.default_limit))
+            self._semaphores[name] = semaphore
+        return semaphore
+
+    async def call(self, name, arguments):
+        """執行單一工具，回傳結果字串；失敗或逾時時拋出例外"""
+        func = self.functions.get(name)
+        if func is None:
+            raise KeyError(f"未知的工具 {name}")
+        if self.cache is None or self.cache.ttl_for(name) <= 0:
+            return await self._execute(name, func, arguments)
+
+        key = cache_key(name, arguments)
+        cached = self.cache.get(key)
+        if cached is not None:
+            print(f"[DEBUG] 工具結果快取命中: {name} {arguments}")
+            return cached
+        inflight = self._inflight.get(key)
+        if inflight is None:
+            inflight = asyncio.ensure_future(self._execute(name, func, arguments, key))
+            self._inflight[key] = inflight
+            inflight.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # shield：其中一個呼叫端被取消時，不影響共用同一結果的其他呼叫端
+        result = await asyncio.shield(inflight)
+        self.cache.put(name, key, result)
+        return result
+
+    async def _execute(self, name, func, arguments, key=None):
+        semaphore = self._semaphore(name)
+        await semaphore.acquire()
+        loop = asyncio.get_running_loop()
+        # 與 asyncio.to_thread 相同，把呼叫端的 contextvars 帶進執行緒
+        future = loop.run_in_executor(self._executor, contextvars.copy_context().run, partial(func, **arguments))
+        # 執行緒真正結束後才釋放名額
+        future.add_done_callback(lambda _: semaphore.release())
+        timeout = self.timeouts.get(name, self.timeout)
+        try:
+            result = await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            if key is not None:
+                # 逾時後執行緒仍會跑完，把遲到的結果寫入快取，避免重新調用時再做一次
+                future.add_done_callback(lambda f: self._cache_late_result(name, key, f))
+            raise ToolTimeoutError(f"超過 {timeout} 秒未完成")
+        return result if isinstance(result, str) else str(result)
+
+    def _cache_late_result(self, name, key, future):
+        if future.cancelled() or future.exception() is not None:
+            return
+        result = future.result()
+        self.cache.put(name, key, result if isinstance(result, str) else str(result))
+
+    async def run_all(self, tool_calls):
+        """
+        同時執行所有工具調用，回傳 [(名稱, 參數, 結果, 例外), ...]（依調用順序）
+        成功時例外為 None，失敗時結果為 None
+        """
+        calls = [(call['function']['name'], parse_arguments(call['function']['arguments'])) for call in tool_calls]
+        results = await asyncio.gather(
+            *(self.call(name, arguments) for name, arguments in calls), return_exceptions=True)
+        return [
+            (name, arguments, None, result) if isinstance(result, BaseException) else (name, arguments, result, None)
+            for (name, arguments), result in zip(calls, results)
+        ]
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)